@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Content-addressed cache of the deployed chain
+
+A snapshot holds the geth data directory (including the deployer/miner keystore), the
+deployment directory, the smart contracts env file and, if one was dumped, the predeployment
+of a finished deployment. It is stored under a key hashing everything the deployment depends
+on, so a build with the same inputs restores it instead of deploying again, and any change
+falls back to a real deploy.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from pathlib import Path
+from typing import Optional, Tuple
+
+import click
+
+SNAPSHOT_DIR = '/var/cache/chain-snapshots'
+CHAIN_ARCHIVE = 'chain.tar.gz'
+DEPLOYMENT_ARCHIVE = 'deployment.tar.gz'
+PREDEPLOY_ARCHIVE = 'predeploy.tar.gz'
+ENV_FILE = 'smartcontracts.sh'
+METADATA_FILE = 'metadata.json'
+
+
+def compute_key(
+    genesis_file: str,
+    contract_version: str,
+    parameter_files: Tuple[str, ...],
+    keystore_file: Optional[str],
+    extra: Tuple[str, ...],
+) -> str:
+    """ Hashes the genesis, contract version, deployer key and deployment parameters """
+    digest = hashlib.sha256()
+
+    def add(label: str, data: bytes) -> None:
+        digest.update(b'%s:%d:' % (label.encode(), len(data)))
+        digest.update(data)
+
+    # the validator/deployer account is generated per build, hash the genesis without it
+    genesis = json.loads(Path(genesis_file).read_text())
+    for validator in genesis['config']['clique'].get('validators', []):
+        genesis['alloc'].pop(validator, None)
+    genesis['config']['clique']['validators'] = []
+    genesis.pop('extraData', None)
+    add('genesis', json.dumps(genesis, sort_keys=True).encode())
+    add('contract-version', contract_version.encode())
+    for parameter_file in parameter_files:
+        add(f'file:{Path(parameter_file).name}', Path(parameter_file).read_bytes())
+    if keystore_file:
+        add('keystore', Path(keystore_file).read_bytes())
+    for value in extra:
+        add('extra', value.encode())
+    return digest.hexdigest()
+
+
+@click.group()
+def main() -> None:
+    pass
+
+
+@main.command()
+@click.option('--genesis', 'genesis_file', required=True, type=click.Path(exists=True))
+@click.option('--contract-version', required=True)
+@click.option(
+    '--parameter-file',
+    'parameter_files',
+    multiple=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help='File defining deployment parameters (e.g. deploy_contracts.py), may be repeated',
+)
+@click.option('--keystore-file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--extra', multiple=True, help='Additional value to key on, e.g. versions')
+def key(
+    genesis_file: str,
+    contract_version: str,
+    parameter_files: Tuple[str, ...],
+    keystore_file: Optional[str],
+    extra: Tuple[str, ...],
+) -> None:
+    """ Prints the snapshot key of a deployment """
+    click.echo(compute_key(genesis_file, contract_version, parameter_files, keystore_file, extra))
+
+
+@main.command()
+@click.option('--key', 'snapshot_key', required=True)
+@click.option('--snapshot-dir', default=SNAPSHOT_DIR, envvar='CHAIN_SNAPSHOT_DIR')
+@click.option('--data-dir', required=True, type=click.Path(file_okay=False))
+@click.option('--deployment-dir', required=True, type=click.Path(file_okay=False))
+@click.option('--env-file', required=True, type=click.Path(dir_okay=False))
+@click.option(
+    '--predeploy-dir',
+    type=click.Path(file_okay=False),
+    help='Restore the predeployment dumped by the deployment here, if the snapshot has one',
+)
+def restore(
+    snapshot_key: str,
+    snapshot_dir: str,
+    data_dir: str,
+    deployment_dir: str,
+    env_file: str,
+    predeploy_dir: Optional[str],
+) -> None:
+    """ Restores a snapshot, exits with 1 if there is none for the key """
+    snapshot = Path(snapshot_dir) / snapshot_key
+    if not (snapshot / METADATA_FILE).exists():
+        click.echo(f'No chain snapshot for key {snapshot_key}')
+        raise SystemExit(1)
+
+    for directory, archive in ((data_dir, CHAIN_ARCHIVE), (deployment_dir, DEPLOYMENT_ARCHIVE)):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        with tarfile.open(snapshot / archive) as tar:
+            tar.extractall(directory)
+    Path(env_file).parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(snapshot / ENV_FILE, env_file)
+    os.chmod(env_file, 0o755)
+    if predeploy_dir and (snapshot / PREDEPLOY_ARCHIVE).exists():
+        os.makedirs(predeploy_dir, exist_ok=True)
+        with tarfile.open(snapshot / PREDEPLOY_ARCHIVE) as tar:
+            tar.extractall(predeploy_dir)
+    click.echo(f'Restored chain snapshot {snapshot_key}')
+
+
+@main.command()
+@click.option('--key', 'snapshot_key', required=True)
+@click.option('--snapshot-dir', default=SNAPSHOT_DIR, envvar='CHAIN_SNAPSHOT_DIR')
+@click.option('--data-dir', required=True, type=click.Path(exists=True, file_okay=False))
+@click.option('--deployment-dir', required=True, type=click.Path(exists=True, file_okay=False))
+@click.option('--env-file', required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--predeploy-dir',
+    type=click.Path(file_okay=False),
+    help='Predeployment dumped by the deployment (see dump_predeploy.py), stored if present',
+)
+@click.option('--replace', is_flag=True, help='Replace an existing snapshot of the key')
+def save(
+    snapshot_key: str,
+    snapshot_dir: str,
+    data_dir: str,
+    deployment_dir: str,
+    env_file: str,
+    predeploy_dir: Optional[str],
+    replace: bool,
+) -> None:
+    """ Stores a finished deployment; geth must not be running """
+    Path(snapshot_dir).mkdir(parents=True, exist_ok=True)
+    snapshot = Path(snapshot_dir) / snapshot_key
+    if (snapshot / METADATA_FILE).exists() and not replace:
+        click.echo(f'Chain snapshot {snapshot_key} already exists')
+        return
+
+    # build next to the final location and rename, so a snapshot is either complete or absent
+    staging = Path(tempfile.mkdtemp(prefix=f'.{snapshot_key}-', dir=snapshot_dir))
+    try:
+        for directory, archive in (
+            (data_dir, CHAIN_ARCHIVE),
+            (deployment_dir, DEPLOYMENT_ARCHIVE),
+        ):
+            with tarfile.open(staging / archive, 'w:gz') as tar:
+                tar.add(directory, arcname='.')
+        if predeploy_dir and (Path(predeploy_dir) / 'alloc.json').exists():
+            with tarfile.open(staging / PREDEPLOY_ARCHIVE, 'w:gz') as tar:
+                tar.add(predeploy_dir, arcname='.')
+        shutil.copyfile(env_file, staging / ENV_FILE)
+        (staging / METADATA_FILE).write_text(json.dumps({'key': snapshot_key}))
+        if replace:
+            shutil.rmtree(snapshot, ignore_errors=True)
+        os.rename(staging, snapshot)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+        if not (snapshot / METADATA_FILE).exists():
+            raise
+    click.echo(f'Stored chain snapshot {snapshot_key}')
+
+
+if __name__ == '__main__':
+    main()
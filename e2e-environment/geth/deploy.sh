@@ -7,15 +7,87 @@ echo "Setting up private chain"
 pip install -U pip wheel
 pip install mypy_extensions click>=7.0 eth_account web3
 
-GETH_RESULT=$(geth --datadir "${DATA_DIR}" account new --password "${PASSWORD_FILE}")
+DEPLOYMENT_REPORT="${SMARTCONTRACTS_ENV_FILE%.sh}.report.json"
 
-ACCOUNT=$(echo "${GETH_RESULT}" | grep -oP 'Public address of the key:\s*\K\w*')
-KEYSTORE_PATH=$(echo "${GETH_RESULT}" | grep -oP 'Path of the secret key file:\s*\K[\/a-zA-Z0-9.-]*')
+# With a predeployment (see dump_predeploy.py) the contracts are part of the genesis and only
+# the token registration is sent, otherwise everything gets deployed and the predeployment
+# for later builds is dumped to ${PREDEPLOY_DIRECTORY}
+if [[ -f "${PREDEPLOY_DIRECTORY}/alloc.json" ]]; then
+  PREDEPLOYED=true
+  PREDEPLOY_KEYSTORE=$(ls "${PREDEPLOY_DIRECTORY}"/keystore/* | head -n 1)
+  GENESIS_OPTIONS=(--predeploy "${PREDEPLOY_DIRECTORY}")
+  SNAPSHOT_OPTIONS=(--keystore-file "${PREDEPLOY_KEYSTORE}")
+  for PREDEPLOY_FILE in "${PREDEPLOY_DIRECTORY}"/*.json "${PREDEPLOY_DIRECTORY}"/smartcontracts.sh; do
+    SNAPSHOT_OPTIONS+=(--parameter-file "${PREDEPLOY_FILE}")
+  done
+else
+  PREDEPLOYED=false
+  GENESIS_OPTIONS=()
+  SNAPSHOT_OPTIONS=()
+fi
+
+# Additional prefunded accounts for load tests, derived deterministically. Their keys are
+# listed in accounts.jsonl and keystores are written with fast test-only KDF parameters.
+PREFUNDED_DIRECTORY="${DATA_DIR}/prefunded"
+PREFUNDED_ACCOUNTS_FILE=/tmp/prefunded.accounts.jsonl
+
+# A previous deployment with identical inputs is restored instead of deploying again, unless
+# FRESH_DEPLOYMENT=true. The validator is generated per build, so the genesis is keyed with
+# a placeholder. The prefunded accounts are derived here once and reused for the real genesis.
+genesis.py --validator 0x0000000000000000000000000000000000000000 --output /tmp/genesis.key.json \
+  --accounts "${PREFUNDED_ACCOUNTS:-0}" --accounts-file "${PREFUNDED_ACCOUNTS_FILE}" \
+  "${GENESIS_OPTIONS[@]}"
+SNAPSHOT_KEY=$(chain_snapshot.py key --genesis /tmp/genesis.key.json \
+  --contract-version "${CONTRACTS_VERSION}" \
+  --parameter-file "$(command -v deploy_contracts.py)" \
+  --extra "$(pip freeze | grep -i raiden.contracts)" \
+  --extra "$(geth version | grep '^Version')" \
+  "${SNAPSHOT_OPTIONS[@]}")
+
+if [[ ${FRESH_DEPLOYMENT:-false} == true ]]; then
+  echo 'Skipping the chain snapshot, FRESH_DEPLOYMENT is set'
+  SAVE_OPTIONS=(--replace)
+elif chain_snapshot.py restore --key "${SNAPSHOT_KEY}" \
+  --data-dir "${DATA_DIR}" \
+  --deployment-dir "${DEPLOYMENT_DIRECTORY}" \
+  --env-file "${SMARTCONTRACTS_ENV_FILE}" \
+  --predeploy-dir "${PREDEPLOY_DIRECTORY}"; then
+  echo 'Deployment restored from snapshot'
+  exit 0
+else
+  SAVE_OPTIONS=()
+fi
+if [[ ${PREDEPLOYED} == false ]]; then
+  # the predeployment dumped below is stored along, so restored builds have it as well
+  SAVE_OPTIONS+=(--predeploy-dir "${PREDEPLOY_DIRECTORY}")
+fi
 
 mkdir -p "${DEPLOYMENT_DIRECTORY}"
 
+if [[ ${PREDEPLOYED} == true ]]; then
+  # the predeployed contracts are owned by the deployer of the reference deployment
+  mkdir -p "${DATA_DIR}/keystore"
+  cp "${PREDEPLOY_KEYSTORE}" "${DATA_DIR}/keystore/"
+  KEYSTORE_PATH="${DATA_DIR}/keystore/$(basename "${PREDEPLOY_KEYSTORE}")"
+  ACCOUNT=0x$(grep -oP '"address":\s*"\K\w*' "${KEYSTORE_PATH}")
+  GENESIS_OPTIONS+=(--deployment-dir "${DEPLOYMENT_DIRECTORY}" --env-file "${SMARTCONTRACTS_ENV_FILE}")
+  DEPLOY_OPTIONS=(--register-token)
+else
+  GETH_RESULT=$(geth --datadir "${DATA_DIR}" account new --password "${PASSWORD_FILE}")
+
+  ACCOUNT=$(echo "${GETH_RESULT}" | grep -oP 'Public address of the key:\s*\K\w*')
+  KEYSTORE_PATH=$(echo "${GETH_RESULT}" | grep -oP 'Path of the secret key file:\s*\K[\/a-zA-Z0-9.-]*')
+  DEPLOY_OPTIONS=(--pipelined)
+fi
+
 echo "${ACCOUNT}" > "${DEPLOYMENT_DIRECTORY}"/miner.sh
-genesis.py --validator "${ACCOUNT}" --output /tmp/genesis.json
+if [[ ${PREFUNDED_ACCOUNTS:-0} -gt 0 ]]; then
+  mkdir -p "${PREFUNDED_DIRECTORY}"
+  GENESIS_OPTIONS+=(--accounts-from "${PREFUNDED_ACCOUNTS_FILE}" \
+    --accounts-file "${PREFUNDED_DIRECTORY}/accounts.jsonl" \
+    --keystore-dir "${PREFUNDED_DIRECTORY}/keystore" --fast-kdf)
+fi
+genesis.py --validator "${ACCOUNT}" --output /tmp/genesis.json "${GENESIS_OPTIONS[@]}"
 geth --datadir "${DATA_DIR}" init /tmp/genesis.json
 
 geth --syncmode full \
@@ -24,8 +96,10 @@ geth --syncmode full \
   --networkid 4321 \
   --nodiscover \
   --http \
-  --http.api "eth,net,web3,txpool" \
+  --http.api "eth,net,web3,txpool,debug" \
+  --cache.preimages \
   --miner.threads 1 \
+  --miner.gaslimit 30000000 \
   --mine \
   --unlock "${ACCOUNT}" \
   --password "${PASSWORD_FILE}" \
@@ -36,11 +110,22 @@ GETH_PID=$!
 deploy_contracts.py --contract-version "${CONTRACTS_VERSION}" \
   --keystore-file "${KEYSTORE_PATH}" \
   --output "${SMARTCONTRACTS_ENV_FILE}" \
-  --password "${PASSWORD}"
+  --password "${PASSWORD}" \
+  --report "${DEPLOYMENT_REPORT}" \
+  "${DEPLOY_OPTIONS[@]}"
+DEPLOY_STATUS=$?
+
+if [[ ${DEPLOY_STATUS} -eq 0 && -f ${SMARTCONTRACTS_ENV_FILE} ]]; then
+  if [[ ${PREDEPLOYED} == false ]]; then
+    cp ${CONTRACTS_VENV}/lib/python3.9/site-packages/raiden_contracts/data_${CONTRACTS_VERSION}/deployment_private_net.json ${DEPLOYMENT_DIRECTORY}
+    cp ${CONTRACTS_VENV}/lib/python3.9/site-packages/raiden_contracts/data_${CONTRACTS_VERSION}/deployment_services_private_net.json ${DEPLOYMENT_DIRECTORY}
 
-if [[ -f ${SMARTCONTRACTS_ENV_FILE} ]]; then
-  cp ${CONTRACTS_VENV}/lib/python3.9/site-packages/raiden_contracts/data_${CONTRACTS_VERSION}/deployment_private_net.json ${DEPLOYMENT_DIRECTORY}
-  cp ${CONTRACTS_VENV}/lib/python3.9/site-packages/raiden_contracts/data_${CONTRACTS_VERSION}/deployment_services_private_net.json ${DEPLOYMENT_DIRECTORY}
+    dump_predeploy.py --report "${DEPLOYMENT_REPORT}" \
+      --keystore-file "${KEYSTORE_PATH}" \
+      --deployment-dir "${DEPLOYMENT_DIRECTORY}" \
+      --env-file "${SMARTCONTRACTS_ENV_FILE}" \
+      --output "${PREDEPLOY_DIRECTORY}" || echo 'Could not dump the predeployment'
+  fi
 
   if [[ ! -f ${DEPLOYMENT_DIRECTORY}/deployment_private_net.json ]]; then
     echo 'Could not find the deployment_private_net.json'
@@ -55,6 +140,13 @@ if [[ -f ${SMARTCONTRACTS_ENV_FILE} ]]; then
   chmod u+x "${SMARTCONTRACTS_ENV_FILE}"
   echo 'Deployment was successful'
   kill -s TERM ${GETH_PID}
+  wait ${GETH_PID}
+
+  chain_snapshot.py save --key "${SNAPSHOT_KEY}" \
+    --data-dir "${DATA_DIR}" \
+    --deployment-dir "${DEPLOYMENT_DIRECTORY}" \
+    --env-file "${SMARTCONTRACTS_ENV_FILE}" \
+    "${SAVE_OPTIONS[@]}" || echo 'Could not store the chain snapshot'
 
   exit 0
 else
@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 import click
 from eth_account import Account
@@ -29,6 +34,8 @@ SERVICE_REGISTRATION_DURATION = 17_280_000 * 10  # 2_000 days
 
 USER_DEPOSIT_WITHDRAW_TIMEOUT = 30
 
+Step = Tuple[str, Callable[[], Any]]
+
 @click.command()
 @click.option("--keystore-file", required=True, type=click.Path(exists=True, dir_okay=False))
 @click.option("--contract-version", default='0.36.0')
@@ -39,8 +46,36 @@ USER_DEPOSIT_WITHDRAW_TIMEOUT = 30
 )
 @click.option('--output', required=True, type=click.Path(dir_okay=False), envvar="DEPLOYMENT_FILE",)
 @click.option("--rpc-url", default="http://localhost:8545")
-def main(keystore_file: str, contract_version: str, password: str, output: str, rpc_url: str):
-    web3 = Web3(HTTPProvider(rpc_url, request_kwargs={'timeout': 60}))
+@click.option(
+    "--pipelined/--sequential",
+    default=False,
+    help="Send independent transactions back to back with local nonces and wait on them together",
+)
+@click.option(
+    "--report",
+    type=click.Path(dir_okay=False),
+    help="JSON timing and gas report [default: next to --output, as <name>.report.json]",
+)
+@click.option(
+    "--register-token",
+    "register_token_only",
+    is_flag=True,
+    help="Only register TTT, with the contracts of an existing --output file (predeployed)",
+)
+def main(
+    keystore_file: str,
+    contract_version: str,
+    password: str,
+    output: str,
+    rpc_url: str,
+    pipelined: bool,
+    report: Optional[str],
+    register_token_only: bool,
+):
+    deployment_report = DeploymentReport('pipelined' if pipelined else 'sequential')
+    web3 = Web3(
+        CountingHTTPProvider(rpc_url, deployment_report, request_kwargs={'timeout': 60})
+    )
     web3.middleware_onion.inject(geth_poa_middleware, layer=0)
 
     with open(keystore_file, 'r') as keystore:
@@ -70,94 +105,92 @@ def main(keystore_file: str, contract_version: str, password: str, output: str,
     )
     print("other version:", deployer.contract_manager.contracts_version)
 
-    print('Deploying Raiden contracts')
-    try:
-        deployed_contracts_info = deployer.deploy_raiden_contracts(
-            max_num_of_token_networks=UNLIMITED,
-            reuse_secret_registry_from_deploy_file=None
+    if register_token_only:
+        addresses = read_env_file(output)
+        print('Registering TTT with the predeployed contracts')
+        run_steps(
+            [
+                (
+                    'Registration of TTT',
+                    lambda: register_token(
+                        deployer,
+                        deployer.contract_manager.get_contract_abi(
+                            CONTRACT_TOKEN_NETWORK_REGISTRY
+                        ),
+                        addresses['TOKEN_NETWORK_REGISTRY_ADDRESS'],
+                        addresses['TTT_TOKEN_ADDRESS'],
+                    ),
+                )
+            ],
+            False,
+            deployment_report,
+            web3,
         )
-    except Exception as err:
-        print(f'Raiden Contract Deployment failed: {err}')
-        exit(1)
+        write_report(deployment_report, web3, report, output)
+        print('done')
+        return
+
+    if pipelined:
+        # must be the outermost middleware, so it runs before the deployer's signing middleware
+        nonces = NonceManager(web3, owner)
+        web3.middleware_onion.add(nonces.middleware, 'nonce_manager')
+
+    def run(*steps: Step) -> List[Any]:
+        return run_steps(steps, pipelined, deployment_report, web3)
+
+    print('Deploying Raiden contracts, TTT and SVT')
+    deployed_contracts_info, (ttt_abi, ttt_token_address), (_, svt_token_address) = run(
+        ('Raiden contract deployment', lambda: deploy_raiden_contracts(deployer)),
+        ('TTT deployment', lambda: deploy_token(deployer)),
+        ('SVT deployment', lambda: deploy_token(deployer, 'ServiceToken', 'SVT')),
+    )
 
     deployed_contracts = {
         contract_name: info['address']
         for contract_name, info in deployed_contracts_info['contracts'].items()
     }
-
-    try:
-        deployer.store_and_verify_deployment_info_raiden(
-            deployed_contracts_info=deployed_contracts_info
-        )
-    except Exception as err:
-        print(f'Contract verification failed: {err}')
-        exit(1)
-
     token_network_registry_address = deployed_contracts[CONTRACT_TOKEN_NETWORK_REGISTRY]
     print(f'Registry contract deployed @ {token_network_registry_address}')
-
-    print('Deploying TTT contract')
-    try:
-        ttt_abi, ttt_token_address = deploy_token(deployer)
-    except Exception as err:
-        print(f'TTT deployment failed: {err}')
-        exit(1)
-
     print(f'Deployed TTT contract @ {ttt_token_address}')
-
-    print('Registering TTT')
-    try:
-        deployer.register_token_network(
-            token_registry_abi=ttt_abi,
-            token_registry_address=token_network_registry_address,
-            token_address=ttt_token_address,
-            channel_participant_deposit_limit=UNLIMITED,
-            token_network_deposit_limit=UNLIMITED,
-        )
-    except Exception as err:
-        print(f'Registration of TTT failed: {err}')
-        exit(1)
-
-    print('Deploying SVT contract')
-    try:
-        svt_abi, svt_token_address = deploy_token(deployer, 'ServiceToken', 'SVT')
-    except Exception as err:
-        print(f'SVT Deployment failed: {err}')
-        exit(1)
-
     print(f'Deployed SVT contract @ {svt_token_address}')
 
     print('Deploying Raiden service contracts')
-    try:
-        deployed_service_contracts_info = deployer.deploy_service_contracts(
-            token_address=svt_token_address,
-            user_deposit_whole_balance_limit=UNLIMITED,
-            user_deposit_withdraw_timeout=USER_DEPOSIT_WITHDRAW_TIMEOUT,
-            service_registry_controller=owner,
-            initial_service_deposit_price=INITIAL_SERVICE_DEPOSIT_PRICE,
-            service_deposit_bump_numerator=SERVICE_DEPOSIT_BUMP_NUMERATOR,
-            service_deposit_bump_denominator=SERVICE_DEPOSIT_BUMP_DENOMINATOR,
-            decay_constant=SERVICE_DEPOSIT_DECAY_CONSTANT,
-            min_price=SERVICE_DEPOSIT_MIN_PRICE,
-            registration_duration=SERVICE_REGISTRATION_DURATION,
-            token_network_registry_address=token_network_registry_address,
-            reuse_service_registry_from_deploy_file=None,
-        )
-    except Exception as err:
-        print(f'Service contract deployment failed: {err}')
-        exit(1)
+    [deployed_service_contracts_info] = run(
+        (
+            'Service contract deployment',
+            lambda: deploy_service_contracts(
+                deployer, owner, svt_token_address, token_network_registry_address
+            ),
+        ),
+    )
 
-    try:
-        deployer.store_and_verify_deployment_info_services(
-            deployed_contracts_info=deployed_service_contracts_info,
-            token_address=svt_token_address,
-            user_deposit_whole_balance_limit=UNLIMITED,
-            user_deposit_withdraw_timeout=USER_DEPOSIT_WITHDRAW_TIMEOUT,
-            token_network_registry_address=token_network_registry_address,
-        )
-    except Exception as err:
-        print(f'Service contract verification failed: {err}')
-        exit(1)
+    # the registration comes last, so the state before it can be predeployed in the genesis
+    # (see dump_predeploy.py), while its TokenNetworkCreated event still gets emitted
+    print('Registering TTT and verifying deployments')
+    run(
+        (
+            'Registration of TTT',
+            lambda: register_token(
+                deployer, ttt_abi, token_network_registry_address, ttt_token_address
+            ),
+        ),
+        (
+            'Contract verification',
+            lambda: deployer.store_and_verify_deployment_info_raiden(
+                deployed_contracts_info=deployed_contracts_info
+            ),
+        ),
+        (
+            'Service contract verification',
+            lambda: deployer.store_and_verify_deployment_info_services(
+                deployed_contracts_info=deployed_service_contracts_info,
+                token_address=svt_token_address,
+                user_deposit_whole_balance_limit=UNLIMITED,
+                user_deposit_withdraw_timeout=USER_DEPOSIT_WITHDRAW_TIMEOUT,
+                token_network_registry_address=token_network_registry_address,
+            ),
+        ),
+    )
 
     if os.path.exists("user_deposit_address"):
         os.remove("user_deposit_address")
@@ -182,9 +215,240 @@ def main(keystore_file: str, contract_version: str, password: str, output: str,
     except Exception as err:
         print(f'Writing environment variables failed: {err}')
 
+    write_report(deployment_report, web3, report, output)
+
     print('done')
 
 
+def read_env_file(path: str) -> Dict[str, str]:
+    """ Reads the ``export NAME=VALUE`` lines of a smartcontracts.sh """
+    values = {}
+    for line in Path(path).read_text().splitlines():
+        name, separator, value = line.replace('export ', '', 1).partition('=')
+        if separator:
+            values[name.strip()] = value.strip()
+    return values
+
+
+def write_report(
+    deployment_report: 'DeploymentReport', web3: Web3, report: Optional[str], output: str
+) -> None:
+    report_file = Path(report) if report else Path(output).with_suffix('.report.json')
+    print(f'Storing deployment report to {report_file}')
+    try:
+        report_file.write_text(json.dumps(deployment_report.finish(web3), indent=2))
+    except Exception as err:
+        print(f'Writing deployment report failed: {err}')
+
+
+class DeploymentReport:
+    """ Collects wall time, blocks, transactions, gas and RPC calls of every deployment step
+
+    RPC calls and sent transactions are attributed to the step running in the calling
+    thread, so concurrent steps are reported separately. Calls outside of a step (account
+    setup, block lookups for the report) only count towards the summary.
+    """
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.started_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.current = threading.local()
+        self.steps: List[Dict[str, Any]] = []
+        self.rpc_calls: Dict[str, int] = {}
+
+    def record_request(self, method: str, response: Any) -> None:
+        step = getattr(self.current, 'step', None)
+        with self.lock:
+            self.rpc_calls[method] = self.rpc_calls.get(method, 0) + 1
+            if step is None:
+                return
+            step['rpc_calls'][method] = step['rpc_calls'].get(method, 0) + 1
+            if method == 'eth_sendRawTransaction' and 'result' in response:
+                step['transaction_hashes'].append(response['result'])
+
+    def track(self, description: str, step: Callable[[], Any], group: int, web3: Web3) -> Any:
+        record: Dict[str, Any] = {
+            'name': description,
+            'group': group,
+            'start_block': web3.eth.blockNumber,
+            'rpc_calls': {},
+            'transaction_hashes': [],
+        }
+        with self.lock:
+            self.steps.append(record)
+        started_at = time.monotonic()
+        self.current.step = record
+        try:
+            return step()
+        finally:
+            self.current.step = None
+            record['started'] = started_at - self.started_at
+            record['wall_time'] = time.monotonic() - started_at
+            record['end_block'] = web3.eth.blockNumber
+
+    def finish(self, web3: Web3) -> Dict[str, Any]:
+        wall_time = time.monotonic() - self.started_at
+        steps = []
+        for record in self.steps:
+            receipts = [
+                web3.eth.getTransactionReceipt(tx_hash) for tx_hash in record['transaction_hashes']
+            ]
+            end_block = max([record['end_block']] + [receipt.blockNumber for receipt in receipts])
+            steps.append(
+                {
+                    'name': record['name'],
+                    'group': record['group'],
+                    'started': record['started'],
+                    'wall_time': record['wall_time'],
+                    'start_block': record['start_block'],
+                    'end_block': end_block,
+                    'blocks': end_block - record['start_block'],
+                    'transactions': len(receipts),
+                    'gas_used': sum(receipt.gasUsed for receipt in receipts),
+                    'rpc_calls': sum(record['rpc_calls'].values()),
+                    'rpc_calls_by_method': record['rpc_calls'],
+                    'transaction_hashes': record['transaction_hashes'],
+                }
+            )
+        return {
+            'mode': self.mode,
+            'steps': steps,
+            'summary': {
+                'wall_time': wall_time,
+                'step_wall_time': {step['name']: step['wall_time'] for step in steps},
+                'groups': len({step['group'] for step in steps}),
+                'start_block': min((step['start_block'] for step in steps), default=None),
+                'end_block': max((step['end_block'] for step in steps), default=None),
+                'transactions': sum(step['transactions'] for step in steps),
+                'gas_used': sum(step['gas_used'] for step in steps),
+                'rpc_calls': sum(self.rpc_calls.values()),
+                'rpc_calls_by_method': self.rpc_calls,
+            },
+        }
+
+
+class CountingHTTPProvider(HTTPProvider):
+    """ HTTPProvider reporting every request to a DeploymentReport """
+
+    def __init__(self, endpoint_uri: str, report: DeploymentReport, **kwargs: Any):
+        super().__init__(endpoint_uri, **kwargs)
+        self.report = report
+
+    def make_request(self, method: str, params: Any) -> Any:
+        response = super().make_request(method, params)
+        self.report.record_request(method, response)
+        return response
+
+
+class NonceManager:
+    """ Hands out the owner's nonces locally
+
+    Transactions sent concurrently would otherwise race on the pending transaction count
+    and reuse a nonce. The nonce is resynchronized with the node after a failed send, so a
+    rejected transaction doesn't leave a gap that blocks all later ones.
+    """
+
+    def __init__(self, web3: Web3, owner: str):
+        self.web3 = web3
+        self.owner = owner
+        self.lock = threading.Lock()
+        self.next_nonce: Optional[int] = None
+
+    def middleware(self, make_request: Callable, web3: Web3) -> Callable:
+        def middleware(method: str, params: Any) -> Any:
+            if method != 'eth_sendTransaction' or 'nonce' in params[0]:
+                return make_request(method, params)
+            # held until the transaction is in the pool, so nonces arrive in order
+            with self.lock:
+                if self.next_nonce is None:
+                    self.next_nonce = self.web3.eth.getTransactionCount(self.owner, 'pending')
+                try:
+                    response = make_request(method, [dict(params[0], nonce=self.next_nonce)])
+                except Exception:
+                    self.next_nonce = None
+                    raise
+                if 'error' in response:
+                    self.next_nonce = None
+                else:
+                    self.next_nonce += 1
+                return response
+
+        return middleware
+
+
+def run_steps(
+    steps: Sequence[Step], pipelined: bool, report: DeploymentReport, web3: Web3
+) -> List[Any]:
+    """ Runs independent steps, concurrently when pipelined, and exits on any failure
+
+    Concurrent steps submit their transactions back to back and wait for the receipts
+    together, so they are mined in the same blocks.
+    """
+    group = len({record['group'] for record in report.steps})
+    if not pipelined:
+        results = []
+        for description, step in steps:
+            try:
+                results.append(report.track(description, step, group, web3))
+            except Exception as err:
+                print(f'{description} failed: {err}')
+                exit(1)
+        return results
+
+    with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+        futures = [
+            (description, executor.submit(report.track, description, step, group, web3))
+            for description, step in steps
+        ]
+    results = []
+    for description, future in futures:
+        try:
+            results.append(future.result())
+        except Exception as err:
+            print(f'{description} failed: {err}')
+            exit(1)
+    return results
+
+
+def deploy_raiden_contracts(deployer: ContractDeployer) -> Dict:
+    return deployer.deploy_raiden_contracts(
+        max_num_of_token_networks=UNLIMITED,
+        reuse_secret_registry_from_deploy_file=None
+    )
+
+
+def register_token(
+    deployer: ContractDeployer, abi: List, token_network_registry_address: str, token_address: str
+) -> None:
+    deployer.register_token_network(
+        token_registry_abi=abi,
+        token_registry_address=token_network_registry_address,
+        token_address=token_address,
+        channel_participant_deposit_limit=UNLIMITED,
+        token_network_deposit_limit=UNLIMITED,
+    )
+
+
+def deploy_service_contracts(
+    deployer: ContractDeployer, owner: str, token_address: str, token_network_registry_address: str
+) -> Dict:
+    return deployer.deploy_service_contracts(
+        token_address=token_address,
+        user_deposit_whole_balance_limit=UNLIMITED,
+        user_deposit_withdraw_timeout=USER_DEPOSIT_WITHDRAW_TIMEOUT,
+        service_registry_controller=owner,
+        initial_service_deposit_price=INITIAL_SERVICE_DEPOSIT_PRICE,
+        service_deposit_bump_numerator=SERVICE_DEPOSIT_BUMP_NUMERATOR,
+        service_deposit_bump_denominator=SERVICE_DEPOSIT_BUMP_DENOMINATOR,
+        decay_constant=SERVICE_DEPOSIT_DECAY_CONSTANT,
+        min_price=SERVICE_DEPOSIT_MIN_PRICE,
+        registration_duration=SERVICE_REGISTRATION_DURATION,
+        token_network_registry_address=token_network_registry_address,
+        reuse_service_registry_from_deploy_file=None,
+    )
+
+
 def deploy_token(deployer: ContractDeployer, name: str = 'TestToken', symbol: str = 'TTT'):
     tokens = TOKEN_SUPPLY * (10 ** TOKEN_DECIMALS)
     deployed_token = deployer.deploy_token_contract(tokens, TOKEN_DECIMALS, name, symbol)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Dumps a reference deployment for predeploying it in the genesis (see genesis.py --predeploy)
+
+Reads code, storage, balance and nonce of every contract deploy_contracts.py deployed (the
+addresses of the deployment files and smartcontracts.sh), and the nonce of the deployer, from
+the state right before the TTT registration. The registration itself stays a transaction, as
+Raiden discovers token networks through its TokenNetworkCreated event, which a genesis can't
+contain. The deployer keystore is copied along, as the predeployed contracts are owned by it
+and it becomes the validator. A deployed contract without code at that state fails the dump.
+
+geth must run with ``--gcmode archive``, ``--cache.preimages`` (storage keys are only known
+from their preimages) and the ``debug`` HTTP API.
+"""
+
+import json
+import re
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Iterable, Set
+
+import click
+from web3 import HTTPProvider, Web3
+
+DEPLOYMENT_FILES = ('deployment_private_net.json', 'deployment_services_private_net.json')
+REGISTRATION_STEP = 'Registration of TTT'
+STORAGE_PAGE_SIZE = 1024
+ADDRESS = re.compile(r'^0x[0-9a-fA-F]{40}$')
+
+
+def rpc(web3: Web3, method: str, *params: Any) -> Any:
+    response = web3.provider.make_request(method, list(params))
+    if 'error' in response:
+        raise click.ClickException(f'{method} failed: {response["error"]}')
+    return response['result']
+
+
+def deployed_addresses(deployment_dir: Path, env_file: Path) -> Set[str]:
+    """ The contracts of the deployment files and the addresses exported by smartcontracts.sh """
+    addresses = set()
+    for name in DEPLOYMENT_FILES:
+        deployment = json.loads((deployment_dir / name).read_text())
+        addresses.update(contract['address'] for contract in deployment['contracts'].values())
+    for line in env_file.read_text().splitlines():
+        value = line.partition('=')[2].strip()
+        if ADDRESS.match(value):
+            addresses.add(value)
+    return {Web3.toChecksumAddress(address) for address in addresses}
+
+
+def dump_storage(web3: Web3, block_hash: str, address: str) -> Dict[str, str]:
+    """ All storage slots of a contract, at the start of the block, paged by their hashes """
+    storage = {}
+    next_key = '0x' + '00' * 32
+    while next_key:
+        result = rpc(
+            web3, 'debug_storageRangeAt', block_hash, 0, address, next_key, STORAGE_PAGE_SIZE
+        )
+        for slot in result['storage'].values():
+            if slot['key'] is None:
+                raise click.ClickException(
+                    f'Storage of {address} has missing preimages, run geth with --cache.preimages'
+                )
+            storage[slot['key']] = '0x' + slot['value'].replace('0x', '').rjust(64, '0')
+        next_key = result['nextKey']
+    return storage
+
+
+def contract_alloc(
+    web3: Web3, block_number: int, addresses: Iterable[str], deployer: str
+) -> Dict[str, Any]:
+    # debug_storageRangeAt reads the state before a transaction of a block, the state after
+    # block_number is the one before the first transaction of the next block
+    next_block = rpc(web3, 'eth_getBlockByNumber', hex(block_number + 1), False)
+    if next_block is None:
+        raise click.ClickException(f'Block {block_number + 1} not mined yet')
+    block = hex(block_number)
+
+    alloc = {}
+    missing = []
+    for address in sorted(addresses):
+        code = rpc(web3, 'eth_getCode', address, block)
+        if code in ('0x', '0x0'):
+            missing.append(address)
+            continue
+        alloc[address] = {
+            'balance': str(int(rpc(web3, 'eth_getBalance', address, block), 16)),
+            'nonce': rpc(web3, 'eth_getTransactionCount', address, block),
+            'code': code,
+            'storage': dump_storage(web3, next_block['hash'], address),
+        }
+    if missing:
+        raise click.ClickException(
+            f'Deployed contracts without code at block {block_number}: {", ".join(missing)}'
+        )
+    # the balance is set by genesis.py, the nonce keeps later deployments off the predeployed
+    # addresses
+    alloc[deployer] = {'nonce': rpc(web3, 'eth_getTransactionCount', deployer, block)}
+    return alloc
+
+
+@click.command()
+@click.option('--rpc-url', default='http://localhost:8545')
+@click.option(
+    '--report',
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help='Deployment report of deploy_contracts.py, locating the TTT registration',
+)
+@click.option('--keystore-file', required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--deployment-dir', required=True, type=click.Path(exists=True, file_okay=False)
+)
+@click.option('--env-file', required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', required=True, type=click.Path(file_okay=False))
+def main(
+    rpc_url: str, report: str, keystore_file: str, deployment_dir: str, env_file: str, output: str
+):
+    web3 = Web3(HTTPProvider(rpc_url, request_kwargs={'timeout': 120}))
+
+    steps = json.loads(Path(report).read_text())['steps']
+    registration = next((step for step in steps if step['name'] == REGISTRATION_STEP), None)
+    if registration is None:
+        raise click.ClickException(f'No "{REGISTRATION_STEP}" step in {report}')
+    # the head when the registration started, with everything before it mined
+    block_number = registration['start_block']
+
+    deployer = Web3.toChecksumAddress(
+        '0x' + json.loads(Path(keystore_file).read_text())['address']
+    )
+    addresses = deployed_addresses(Path(deployment_dir), Path(env_file))
+    alloc = contract_alloc(web3, block_number, addresses, deployer)
+    print(f'Dumped {len(addresses)} contracts at block {block_number}')
+
+    output_dir = Path(output)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    (output_dir / 'keystore').mkdir(parents=True)
+    (output_dir / 'alloc.json').write_text(json.dumps(alloc, indent=2, sort_keys=True))
+    shutil.copy(keystore_file, output_dir / 'keystore')
+    shutil.copy(env_file, output_dir / 'smartcontracts.sh')
+    for name in DEPLOYMENT_FILES:
+        deployment = json.loads((Path(deployment_dir) / name).read_text())
+        # in the predeployed chain, every contract exists from the genesis on and there are no
+        # deployment transactions, see verify_predeploy.py
+        for contract in deployment['contracts'].values():
+            contract.update(block_number=0, transaction_hash=None, gas_cost=None)
+        (output_dir / name).write_text(json.dumps(deployment, indent=2))
+    print(f'Stored predeployment to {output_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 
+import hashlib
 import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import chain
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
 
 import click
+from eth_account import Account
 
 GENESIS_STUB: Dict = {
     "config": {
@@ -32,14 +39,189 @@ GENESIS_STUB: Dict = {
     "difficulty": "1",
     "mixHash": "0x0000000000000000000000000000000000000000000000000000000000000000",
     "nonce": "0x0",
-    "gasLimit": "0xa00000"
+    "gasLimit": "0x1c9c380"
 }
 
+# secp256k1 group order, private keys must be in [1, n)
+SECP256K1_N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAE6DCE6AF48A03BBFD25E8CD0364141
+# default scrypt n is 262144, which takes around a second per keystore; test chains only!
+FAST_SCRYPT_N = 2 ** 10
+ACCOUNTS_PER_TASK = 1000
+
+GeneratedAccount = Tuple[str, str]
+
+
+def derive_private_key(seed: str, index: int) -> bytes:
+    """ Deterministic private key of account ``index``, the same for every run with ``seed`` """
+    counter = 0
+    while True:
+        digest = hashlib.sha256(f'{seed}:{index}:{counter}'.encode()).digest()
+        if 0 < int.from_bytes(digest, 'big') < SECP256K1_N:
+            return digest
+        counter += 1
+
+
+def write_keystore(
+    keystore_dir: str, address: str, private_key: bytes, password: str, fast_kdf: bool
+) -> None:
+    keystore = Account.encrypt(
+        private_key, password, kdf='scrypt', iterations=FAST_SCRYPT_N if fast_kdf else None
+    )
+    timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H-%M-%S.%fZ')
+    path = Path(keystore_dir) / f'UTC--{timestamp}--{address[2:].lower()}'
+    path.write_text(json.dumps(keystore))
+
+
+def generate_accounts(
+    seed: str,
+    start: int,
+    stop: int,
+    keystore_dir: Optional[str],
+    password: str,
+    fast_kdf: bool,
+    known: Optional[List[GeneratedAccount]] = None,
+) -> List[GeneratedAccount]:
+    """
+    Derives accounts ``start`` to ``stop``, unless they are ``known`` already, writing their
+    keystores if a directory is given
+    """
+    if known is None:
+        known = []
+        for index in range(start, stop):
+            private_key = derive_private_key(seed, index)
+            known.append((Account.from_key(private_key).address, '0x' + private_key.hex()))
+    if keystore_dir:
+        for address, private_key in known:
+            write_keystore(
+                keystore_dir, address, bytes.fromhex(private_key[2:]), password, fast_kdf
+            )
+    return known
+
+
+def read_accounts(path: str) -> List[GeneratedAccount]:
+    """ Reads the accounts of an ``--accounts-file``, in index order """
+    with open(path) as accounts_file:
+        entries = [json.loads(line) for line in accounts_file if line.strip()]
+    entries.sort(key=lambda entry: entry['index'])
+    return [(entry['address'], entry['private_key']) for entry in entries]
+
+
+def iter_accounts(
+    count: int,
+    seed: str,
+    keystore_dir: Optional[str],
+    password: str,
+    fast_kdf: bool,
+    workers: int,
+    known: Optional[List[GeneratedAccount]] = None,
+) -> Iterator[GeneratedAccount]:
+    """
+    Generates the accounts in chunks across processes, yielding them in index order. ``known``
+    accounts are taken as they are, only their keystores are written.
+    """
+    if known is not None:
+        count = len(known)
+    if keystore_dir:
+        Path(keystore_dir).mkdir(parents=True, exist_ok=True)
+    starts = range(0, count, ACCOUNTS_PER_TASK)
+    stops = [min(start + ACCOUNTS_PER_TASK, count) for start in starts]
+    known_chunks = [
+        known[start:stop] if known is not None else None for start, stop in zip(starts, stops)
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = executor.map(
+            generate_accounts,
+            [seed] * len(starts),
+            starts,
+            stops,
+            [keystore_dir] * len(starts),
+            [password] * len(starts),
+            [fast_kdf] * len(starts),
+            known_chunks,
+        )
+        for chunk in chunks:
+            yield from chunk
+
+
+def write_genesis(file: TextIO, genesis: Dict, alloc: Iterable[Tuple[str, Dict]]) -> None:
+    """ Writes the genesis JSON, streaming the alloc instead of building it in memory """
+    file.write('{\n  "alloc": {')
+    for position, (address, account) in enumerate(alloc):
+        separator = ',' if position else ''
+        file.write(f'{separator}\n    {json.dumps(address)}: {json.dumps(account)}')
+    file.write('\n  }')
+    for key, value in genesis.items():
+        if key != 'alloc':
+            rendered = json.dumps(value, indent=2).replace('\n', '\n  ')
+            file.write(f',\n  {json.dumps(key)}: {rendered}')
+    file.write('\n}\n')
+
 
 @click.command()
 @click.option('--validator', required=True, type=str)
 @click.option('--output', required=True, type=click.Path(), default="genesis.json")
-def main(validator: str, output: str):
+@click.option(
+    '--predeploy',
+    type=click.Path(exists=True, file_okay=False),
+    help='Directory written by dump_predeploy.py, its contracts are put into the alloc',
+)
+@click.option(
+    '--deployment-dir',
+    type=click.Path(file_okay=False),
+    help='Where to write the deployment files of the predeployed contracts',
+)
+@click.option(
+    '--env-file',
+    type=click.Path(dir_okay=False),
+    help='Where to write the smartcontracts.sh of the predeployed contracts',
+)
+@click.option('--accounts', default=0, show_default=True, help='Number of accounts to prefund')
+@click.option(
+    '--seed',
+    default='raiden-e2e',
+    show_default=True,
+    help='Seed the prefunded accounts are derived from',
+)
+@click.option(
+    '--accounts-from',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Prefund the accounts of an --accounts-file of an earlier run instead of deriving them',
+)
+@click.option(
+    '--accounts-file',
+    type=click.Path(dir_okay=False),
+    help='Write address and private key of every generated account here, one JSON per line',
+)
+@click.option(
+    '--keystore-dir',
+    type=click.Path(file_okay=False),
+    help='Write a keystore for every generated account into this directory',
+)
+@click.option('--keystore-password', envvar='PASSWORD', default='', help='[env: PASSWORD]')
+@click.option(
+    '--fast-kdf',
+    is_flag=True,
+    help=f'Encrypt the keystores with scrypt n={FAST_SCRYPT_N}, for test chains only',
+)
+@click.option('--workers', type=int, help='Processes generating accounts [default: CPU count]')
+def main(
+    validator: str,
+    output: str,
+    predeploy: Optional[str],
+    deployment_dir: Optional[str],
+    env_file: Optional[str],
+    accounts: int,
+    seed: str,
+    accounts_from: Optional[str],
+    accounts_file: Optional[str],
+    keystore_dir: Optional[str],
+    keystore_password: str,
+    fast_kdf: bool,
+    workers: Optional[int],
+):
+    if accounts and accounts_from:
+        raise click.UsageError('--accounts and --accounts-from are mutually exclusive')
+
     initial_balance = {"balance": "100000000000000000000000"}
 
     prefunded_account = [
@@ -58,12 +240,50 @@ def main(validator: str, output: str):
     for account in prefunded_account:
         GENESIS_STUB['alloc'][account] = initial_balance
 
+    if predeploy:
+        predeploy_dir = Path(predeploy)
+        alloc = json.loads((predeploy_dir / 'alloc.json').read_text())
+        existing = {address.lower(): address for address in GENESIS_STUB['alloc']}
+        for address, account in alloc.items():
+            address = existing.get(address.lower(), address)
+            # the deployer keeps its prefunded balance and gets its nonce from the dump
+            GENESIS_STUB['alloc'][address] = {
+                'balance': '0',
+                **GENESIS_STUB['alloc'].get(address, {}),
+                **account,
+            }
+        if deployment_dir:
+            Path(deployment_dir).mkdir(parents=True, exist_ok=True)
+            for deployment_file in predeploy_dir.glob('deployment_*.json'):
+                shutil.copy(deployment_file, deployment_dir)
+        if env_file:
+            shutil.copy(predeploy_dir / 'smartcontracts.sh', env_file)
+
     signer = validator.lower().replace('0x', '')
     GENESIS_STUB[
         'extraData'
     ] = f'0x0000000000000000000000000000000000000000000000000000000000000000{signer}0000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000'
-    output_file = Path(output)
-    output_file.write_text(json.dumps(GENESIS_STUB, indent=2))
+
+    generated = iter_accounts(
+        accounts,
+        seed,
+        keystore_dir,
+        keystore_password,
+        fast_kdf,
+        workers or os.cpu_count() or 1,
+        read_accounts(accounts_from) if accounts_from else None,
+    )
+    with open(output, 'w') as output_file, open(accounts_file or os.devnull, 'w') as keys_file:
+
+        def prefund() -> Iterator[Tuple[str, Dict]]:
+            for index, (address, private_key) in enumerate(generated):
+                keys_file.write(
+                    json.dumps({'index': index, 'address': address, 'private_key': private_key})
+                    + '\n'
+                )
+                yield address, initial_balance
+
+        write_genesis(output_file, GENESIS_STUB, chain(GENESIS_STUB['alloc'].items(), prefund()))
 
 
 if __name__ == '__main__':
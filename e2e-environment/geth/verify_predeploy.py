@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Verifies the contracts of a predeployed chain (see dump_predeploy.py)
+
+raiden_contracts.deploy verify checks the receipts of the deployment transactions, which a
+chain with the contracts in its genesis doesn't have. Instead this compares the code at every
+address of the deployment files with the compiled runtime code, and checks that the addresses
+of smartcontracts.sh (the tokens) have code.
+"""
+
+import json
+import re
+from pathlib import Path
+
+import click
+from raiden_contracts.contract_manager import ContractManager, contracts_precompiled_path
+from web3 import HTTPProvider, Web3
+
+from dump_predeploy import DEPLOYMENT_FILES
+
+ADDRESS = re.compile(r'^export (\w+)=(0x[0-9a-fA-F]{40})$')
+
+
+def is_predeployed(deployment_dir: Path) -> bool:
+    """ dump_predeploy.py leaves out the deployment transactions """
+    deployment = json.loads((deployment_dir / DEPLOYMENT_FILES[0]).read_text())
+    return all(
+        contract['transaction_hash'] is None for contract in deployment['contracts'].values()
+    )
+
+
+@click.command()
+@click.option('--rpc-url', default='http://localhost:8545')
+@click.option('--contract-version', required=True)
+@click.option(
+    '--deployment-dir', required=True, type=click.Path(exists=True, file_okay=False)
+)
+@click.option('--env-file', required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--detect',
+    is_flag=True,
+    help='Exit with 0 if the deployment is predeployed and 1 otherwise, without verifying it',
+)
+def main(rpc_url: str, contract_version: str, deployment_dir: str, env_file: str, detect: bool):
+    if detect:
+        raise SystemExit(0 if is_predeployed(Path(deployment_dir)) else 1)
+
+    web3 = Web3(HTTPProvider(rpc_url))
+    contract_manager = ContractManager(contracts_precompiled_path(contract_version))
+
+    errors = []
+    for name in DEPLOYMENT_FILES:
+        deployment = json.loads((Path(deployment_dir) / name).read_text())
+        for contract_name, contract in deployment['contracts'].items():
+            code = web3.eth.getCode(contract['address']).hex()
+            if code != contract_manager.get_runtime_hexcode(contract_name):
+                errors.append(f'{contract_name} at {contract["address"]} has unexpected code')
+    for line in Path(env_file).read_text().splitlines():
+        match = ADDRESS.match(line.strip())
+        if match and web3.eth.getCode(match.group(2)) in (b'', None):
+            errors.append(f'{match.group(1)} at {match.group(2)} has no code')
+
+    if errors:
+        raise click.ClickException('\n'.join(errors))
+    print('Predeployed contracts verified')
+
+
+if __name__ == '__main__':
+    main()
@@ -27,7 +27,11 @@ else
 fi
 
 echo -e "\nWait to make sure all services are up and running"
-sleep 10s
+if command -v python3 >/dev/null; then
+  python3 "${E2E_ENVIRONMENT_DIRECTORY}/setup/wait_for_services.py" --timeout 120 || exit 1
+else
+  sleep 10s
+fi
 
 # fix pollingInterval in raiden nodes and print config
 curl -X PATCH -H 'content-type: application/json' \
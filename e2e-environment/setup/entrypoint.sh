@@ -4,4 +4,10 @@ source /etc/profile.d/smartcontracts.sh
 MINER_ACCOUNT=$(cat /opt/deployment/miner.sh)
 export MINER_ACCOUNT
 
+# Rendered here as well, as the programs of Synapse workers and cluster homeservers must be
+# known to supervisord
+/opt/synapse/venv/bin/python /usr/local/bin/render_config_template.py
+# the URL of the (first) homeserver for the Raiden nodes and the PFS
+source /opt/synapse/config/matrix_server.sh
+
 /usr/bin/supervisord
\ No newline at end of file
@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+"""
+Lines up the service logs of an end-to-end run on one timeline
+
+Parses the logs copied from /var/log/supervisor (Raiden nodes, PFS, Synapse, geth and
+supervisord itself) line by line and merges them by timestamp, so no file is loaded as a whole.
+From the timeline it extracts the durations of the setup phases and the latency of every
+payment sent by a node, and writes them as a JSON or HTML report. Two JSON reports can be
+compared with the diff command.
+
+Only uses the standard library, as it also runs on the host in shared-script.sh:
+
+    log_timeline.py analyze ./logs --output timeline.json
+    log_timeline.py diff base/timeline.json timeline.json
+"""
+
+import argparse
+import heapq
+import html
+import json
+import math
+import re
+import sys
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+# continuation lines of a record (e.g. the state dumps of the redux logger) are cut off here
+MAX_RECORD_LENGTH = 16384
+
+# raiden-cli: 2021-08-10T12:00:00.123Z [info] => message, the first line names the logger
+CLI_LINE = re.compile(
+    r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?Z?) (?:@ \S+ )?\[(\w+)\] => ?(.*)$'
+)
+# Synapse, supervisord and structlog console output: 2021-08-10 12:00:00,123 message
+DATED_LINE = re.compile(r'^(\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d(?:[,.]\d+)?) (.*)$')
+# geth: INFO [08-10|12:00:00.123] message
+GETH_LINE = re.compile(
+    r'^(TRACE|DEBUG|INFO|WARN|ERROR|CRIT)\s*\[(\d\d-\d\d\|\d\d:\d\d:\d\d(?:\.\d+)?)\] (.*)$'
+)
+LEVEL = re.compile(r'\b(DEBUG|INFO|WARNING|WARN|ERROR|CRITICAL|CRIT)\b', re.IGNORECASE)
+# supervisord names its program logs <program>-stdout---supervisor-<random>.log
+SUPERVISOR_LOG = re.compile(r'^(.+?)-std(?:out|err)---supervisor-\w+\.log$')
+
+ACTION_TYPE = re.compile(r"type: '(transfer/(?:request|success|failure))'")
+SECRETHASH = re.compile(r"secrethash: '(0x[0-9a-fA-F]{64})'")
+DIRECTION = re.compile(r"direction: '(sent|received)'")
+
+# Each phase lasts from its start to its end marker. A marker matches the first event whose
+# source and message match its regexes, without a pattern the first event of the source. The
+# end is searched from the start on, with same_source only in the log of the start event.
+PHASES: List[Dict[str, Any]] = [
+    {
+        'name': 'chain_start',
+        'start': {'source': '^geth$'},
+        'end': {'source': '^geth$', 'pattern': 'Successfully sealed new block'},
+    },
+    # from the first line of a node until its Raiden client starts
+    {
+        'name': 'node_startup',
+        'start': {'source': r'^node\d+$'},
+        'end': {'source': r'^node\d+$', 'pattern': 'Starting Raiden Light-Client'},
+        'same_source': True,
+    },
+    {
+        'name': 'pfs_ready',
+        'start': {'source': '^pfs$'},
+        'end': {'source': '^pfs$', 'pattern': r'(?i)start(ing|ed) (api|server)|running on'},
+    },
+    {
+        'name': 'node_sync',
+        'start': {'source': r'^node\d+$', 'pattern': 'raiden/started'},
+        'end': {'source': r'^node\d+$', 'pattern': 'raiden/synced'},
+        'same_source': True,
+    },
+    {
+        'name': 'channel_open',
+        'start': {'source': r'^node\d+$', 'pattern': 'channel/open/request'},
+        'end': {'source': r'^node\d+$', 'pattern': 'channel/open/success'},
+        'same_source': True,
+    },
+    {
+        'name': 'first_payment',
+        'start': {'source': r'^node\d+$', 'pattern': 'transfer/request'},
+        'end': {'source': r'^node\d+$', 'pattern': 'transfer/success'},
+        'same_source': True,
+    },
+]
+
+
+@dataclass
+class Event:
+    timestamp: float
+    source: str
+    level: str
+    message: str
+
+
+def parse_timestamp(value: str, year: Optional[int] = None) -> float:
+    """ Seconds since the epoch, timestamps without zone are in UTC like in the container """
+    value = value.rstrip('Z').replace(',', '.').replace('T', ' ')
+    if year is not None:
+        # geth leaves out the year
+        value = f'{year}-{value.replace("|", " ")}'
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S'
+    return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc).timestamp()
+
+
+def parse_json_line(line: str) -> Optional[Dict[str, Any]]:
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
+
+
+def parse_line(line: str, source: str, year: int) -> Optional[Event]:
+    """ The event starting at this line, None for a continuation of the previous one """
+    if line.startswith('{'):
+        record = parse_json_line(line)
+        timestamp = record and (record.get('timestamp') or record.get('time'))
+        if record and isinstance(timestamp, str):
+            message = record.get('event') or record.get('message') or record.get('msg') or ''
+            details = {
+                key: value
+                for key, value in record.items()
+                if key not in ('timestamp', 'time', 'event', 'message', 'msg', 'level')
+            }
+            if details:
+                message = f'{message} {json.dumps(details, sort_keys=True)}'
+            return Event(
+                parse_timestamp(timestamp), source, str(record.get('level', '')).lower(), message
+            )
+    match = CLI_LINE.match(line)
+    if match:
+        return Event(parse_timestamp(match[1]), source, match[2].lower(), match[3])
+    match = DATED_LINE.match(line)
+    if match:
+        level = LEVEL.search(match[2])
+        return Event(
+            parse_timestamp(match[1]), source, level[1].lower() if level else '', match[2]
+        )
+    match = GETH_LINE.match(line)
+    if match:
+        return Event(parse_timestamp(match[2], year), source, match[1].lower(), match[3])
+    return None
+
+
+def log_source(path: Path) -> str:
+    match = SUPERVISOR_LOG.match(path.name)
+    return match[1] if match else path.stem
+
+
+def read_events(path: Path) -> Iterator[Event]:
+    """ Yields the events of a log file, with continuation lines appended to their event """
+    source = log_source(path)
+    year = datetime.fromtimestamp(path.stat().st_mtime, timezone.utc).year
+    current: Optional[Event] = None
+    with path.open(errors='replace') as file:
+        for line in file:
+            line = line.rstrip('\n')
+            event = parse_line(line, source, year)
+            if event is not None:
+                if current is not None:
+                    yield current
+                current = event
+            elif current is not None and len(current.message) < MAX_RECORD_LENGTH:
+                current.message = f'{current.message}\n{line}'[:MAX_RECORD_LENGTH]
+    if current is not None:
+        yield current
+
+
+def merge_events(log_dir: Path) -> Iterator[Event]:
+    """
+    The events of all logs in timestamp order. Each log is read lazily and assumed to be in
+    order by itself, which holds up to the rare line written by a concurrent thread.
+    """
+    paths = sorted(path for path in log_dir.rglob('*.log') if path.is_file())
+    return heapq.merge(*(read_events(path) for path in paths), key=lambda event: event.timestamp)
+
+
+def offset(timestamp: float, origin: float) -> float:
+    return round(timestamp - origin, 3)
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Marker:
+    def __init__(self, definition: Dict[str, Any]):
+        self.source = re.compile(definition.get('source', ''))
+        self.pattern = re.compile(definition['pattern']) if 'pattern' in definition else None
+
+    def matches(self, event: Event, source: Optional[str] = None) -> bool:
+        if source is not None and event.source != source:
+            return False
+        if not self.source.search(event.source):
+            return False
+        return self.pattern is None or bool(self.pattern.search(event.message))
+
+
+class PhaseTracker:
+    """ Finds the start and end marker of a phase in a single pass over the timeline """
+
+    def __init__(self, definition: Dict[str, Any]):
+        self.name = definition['name']
+        self.start_marker = Marker(definition['start'])
+        self.end_marker = Marker(definition['end'])
+        self.same_source = definition.get('same_source', False)
+        self.start: Optional[Event] = None
+        self.end: Optional[Event] = None
+
+    def feed(self, event: Event) -> None:
+        if self.end is not None:
+            return
+        if self.start is None:
+            if self.start_marker.matches(event):
+                self.start = event
+            else:
+                return
+        source = self.start.source if self.same_source else None
+        if self.end_marker.matches(event, source):
+            self.end = event
+
+    def result(self, origin: float) -> Dict[str, Any]:
+        start = offset(self.start.timestamp, origin) if self.start else None
+        end = offset(self.end.timestamp, origin) if self.end else None
+        return {
+            'name': self.name,
+            'start': start,
+            'end': end,
+            'duration': round(end - start, 3) if start is not None and end is not None else None,
+            'start_source': self.start.source if self.start else None,
+            'end_source': self.end.source if self.end else None,
+        }
+
+
+class PaymentTracker:
+    """ Pairs the transfer request of a sending node with its success or failure """
+
+    def __init__(self) -> None:
+        self.pending: Dict[Tuple[str, str], float] = {}
+        self.payments: List[Dict[str, Any]] = []
+
+    def feed(self, event: Event) -> None:
+        action = ACTION_TYPE.search(event.message)
+        if not action:
+            return
+        secrethash = SECRETHASH.search(event.message)
+        direction = DIRECTION.search(event.message)
+        if not secrethash or (direction and direction[1] != 'sent'):
+            return
+        key = (event.source, secrethash[1])
+        if action[1] == 'transfer/request':
+            self.pending.setdefault(key, event.timestamp)
+        elif key in self.pending:
+            started = self.pending.pop(key)
+            self.payments.append(
+                {
+                    'node': event.source,
+                    'secrethash': secrethash[1],
+                    'started': started,
+                    'latency': round(event.timestamp - started, 3),
+                    'success': action[1] == 'transfer/success',
+                }
+            )
+
+    def result(self, origin: float) -> Dict[str, Any]:
+        latencies = sorted(payment['latency'] for payment in self.payments if payment['success'])
+        return {
+            'count': len(self.payments),
+            'succeeded': len(latencies),
+            'unfinished': len(self.pending),
+            'latency': {
+                'p50': percentile(latencies, 0.50),
+                'p90': percentile(latencies, 0.90),
+                'p99': percentile(latencies, 0.99),
+                'max': latencies[-1] if latencies else None,
+            },
+            'payments': [
+                {**payment, 'started': offset(payment['started'], origin)}
+                for payment in self.payments
+            ],
+        }
+
+
+def analyze(
+    log_dir: Path, phases: List[Dict[str, Any]], timeline: Optional[TextIO]
+) -> Dict[str, Any]:
+    trackers = [PhaseTracker(definition) for definition in phases]
+    payments = PaymentTracker()
+    sources: Dict[str, Dict[str, Any]] = {}
+    origin: Optional[float] = None
+    last = 0.0
+    for event in merge_events(log_dir):
+        if origin is None:
+            origin = event.timestamp
+        last = event.timestamp
+        for tracker in trackers:
+            tracker.feed(event)
+        payments.feed(event)
+        stats = sources.setdefault(
+            event.source, {'events': 0, 'errors': 0, 'first': offset(event.timestamp, origin)}
+        )
+        stats['events'] += 1
+        stats['errors'] += event.level in ('error', 'critical', 'crit')
+        stats['last'] = offset(event.timestamp, origin)
+        if timeline is not None:
+            timeline.write(
+                json.dumps({**asdict(event), 'offset': offset(event.timestamp, origin)}) + '\n'
+            )
+
+    if origin is None:
+        raise SystemExit(f'No log events found in {log_dir}')
+    return {
+        'log_dir': str(log_dir),
+        'started_at': datetime.fromtimestamp(origin, timezone.utc).isoformat(),
+        'duration': offset(last, origin),
+        'phases': [tracker.result(origin) for tracker in trackers],
+        'payments': payments.result(origin),
+        'sources': sources,
+    }
+
+
+def diff(base: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+    def delta(before: Optional[float], after: Optional[float]) -> Dict[str, Any]:
+        change = after - before if before is not None and after is not None else None
+        return {
+            'base': before,
+            'other': after,
+            'delta': change,
+            'ratio': after / before if change is not None and before else None,
+        }
+
+    base_phases = {phase['name']: phase['duration'] for phase in base['phases']}
+    other_phases = {phase['name']: phase['duration'] for phase in other['phases']}
+    names = list(base_phases) + [name for name in other_phases if name not in base_phases]
+    return {
+        'base': base['log_dir'],
+        'other': other['log_dir'],
+        'duration': delta(base['duration'], other['duration']),
+        'phases': {
+            name: delta(base_phases.get(name), other_phases.get(name)) for name in names
+        },
+        'payments': {
+            'succeeded': delta(base['payments']['succeeded'], other['payments']['succeeded']),
+            **{
+                f'latency_{key}': delta(
+                    base['payments']['latency'][key], other['payments']['latency'][key]
+                )
+                for key in ('p50', 'p90', 'p99', 'max')
+            },
+        },
+    }
+
+
+def seconds(value: Optional[float]) -> str:
+    return '-' if value is None else f'{value:.3f}s'
+
+
+def render_html(report: Dict[str, Any]) -> str:
+    scale = 100 / report['duration'] if report['duration'] else 0
+    rows = []
+    for phase in report['phases']:
+        bar = ''
+        if phase['duration'] is not None:
+            bar = (
+                f'<div style="margin-left:{phase["start"] * scale:.2f}%;'
+                f'width:{max(phase["duration"] * scale, 0.2):.2f}%;'
+                'background:#3b7dd8;height:1em"></div>'
+            )
+        rows.append(
+            f'<tr><td>{html.escape(phase["name"])}</td><td>{seconds(phase["start"])}</td>'
+            f'<td>{seconds(phase["duration"])}</td>'
+            f'<td>{html.escape(phase["end_source"] or "")}</td>'
+            f'<td style="width:50%">{bar}</td></tr>'
+        )
+    payments = report['payments']
+    latency = payments['latency']
+    payment_rows = [
+        f'<tr><td>{html.escape(payment["node"])}</td><td>{seconds(payment["started"])}</td>'
+        f'<td>{seconds(payment["latency"])}</td><td>{"yes" if payment["success"] else "no"}</td>'
+        f'<td><code>{payment["secrethash"]}</code></td></tr>'
+        for payment in payments['payments']
+    ]
+    source_rows = [
+        f'<tr><td>{html.escape(name)}</td><td>{stats["events"]}</td><td>{stats["errors"]}</td>'
+        f'<td>{seconds(stats["first"])}</td><td>{seconds(stats["last"])}</td></tr>'
+        for name, stats in sorted(report['sources'].items())
+    ]
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>End-to-end run timeline</title>
+<style>
+body {{ font-family: sans-serif; }}
+table {{ border-collapse: collapse; margin-bottom: 2em; }}
+td, th {{ border: 1px solid #ccc; padding: 0.2em 0.6em; text-align: left; }}
+</style>
+</head>
+<body>
+<h1>End-to-end run timeline</h1>
+<p>{html.escape(report['log_dir'])}, started at {html.escape(report['started_at'])},
+lasted {seconds(report['duration'])}</p>
+<h2>Phases</h2>
+<table>
+<tr><th>Phase</th><th>Start</th><th>Duration</th><th>Ended in</th><th>Timeline</th></tr>
+{''.join(rows)}
+</table>
+<h2>Payments</h2>
+<p>{payments['succeeded']}/{payments['count']} succeeded, {payments['unfinished']} unfinished,
+latency p50 {seconds(latency['p50'])} p90 {seconds(latency['p90'])}
+p99 {seconds(latency['p99'])} max {seconds(latency['max'])}</p>
+<table>
+<tr><th>Node</th><th>Start</th><th>Latency</th><th>Success</th><th>Secret hash</th></tr>
+{''.join(payment_rows)}
+</table>
+<h2>Logs</h2>
+<table>
+<tr><th>Source</th><th>Events</th><th>Errors</th><th>First</th><th>Last</th></tr>
+{''.join(source_rows)}
+</table>
+</body>
+</html>
+"""
+
+
+def print_summary(report: Dict[str, Any]) -> None:
+    print(f'Run of {report["duration"]:.1f}s:')
+    for phase in report['phases']:
+        print(f'  {phase["name"]:<16} {seconds(phase["duration"]):>10}')
+    payments = report['payments']
+    latency = payments['latency']
+    print(
+        f'  {payments["succeeded"]}/{payments["count"]} payments succeeded, latency '
+        f'p50 {seconds(latency["p50"])} p90 {seconds(latency["p90"])} '
+        f'p99 {seconds(latency["p99"])}'
+    )
+
+
+def print_diff(result: Dict[str, Any]) -> None:
+    def line(name: str, values: Dict[str, Any]) -> None:
+        change = '-' if values['delta'] is None else f'{values["delta"]:+.3f}s'
+        print(
+            f'  {name:<18} {seconds(values["base"]):>10} {seconds(values["other"]):>10} '
+            f'{change:>10}'
+        )
+
+    print(f'{"":<20} {"base":>10} {"other":>10} {"delta":>10}')
+    line('duration', result['duration'])
+    for name, values in result['phases'].items():
+        line(name, values)
+    for name, values in result['payments'].items():
+        if name != 'succeeded':
+            line(name, values)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    analyze_parser = commands.add_parser('analyze', help='Analyze the logs of a run')
+    analyze_parser.add_argument('log_dir', help='Directory with the logs of /var/log/supervisor')
+    analyze_parser.add_argument(
+        '--output', help='Write the report to this file, as HTML if it ends with .html'
+    )
+    analyze_parser.add_argument(
+        '--timeline', help='Write every event of the merged timeline as JSON lines to this file'
+    )
+    analyze_parser.add_argument(
+        '--phases', help='JSON file with phase definitions replacing the built-in ones'
+    )
+
+    diff_parser = commands.add_parser('diff', help='Compare the JSON reports of two runs')
+    diff_parser.add_argument('base')
+    diff_parser.add_argument('other')
+    diff_parser.add_argument('--output', help='Write the comparison as JSON to this file')
+    args = parser.parse_args()
+
+    if args.command == 'diff':
+        with open(args.base) as base_file, open(args.other) as other_file:
+            result = diff(json.load(base_file), json.load(other_file))
+        print_diff(result)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(result, file, indent=2)
+        return 0
+
+    log_dir = Path(args.log_dir)
+    if not log_dir.is_dir():
+        raise SystemExit(f'{log_dir} is not a directory')
+    phases = PHASES
+    if args.phases:
+        with open(args.phases) as file:
+            phases = json.load(file)
+    if args.timeline:
+        with open(args.timeline, 'w') as timeline:
+            report = analyze(log_dir, phases, timeline)
+    else:
+        report = analyze(log_dir, phases, None)
+
+    print_summary(report)
+    if args.output:
+        with open(args.output, 'w') as file:
+            if args.output.endswith('.html'):
+                file.write(render_html(report))
+            else:
+                json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+Payment load generator for the nodes of the end-to-end environment
+
+Sends payments through ``/api/v1/payments/<token>/<target>`` between the nodes of a topology
+(see topology.py, by default node1 and node2), either open-loop at a given arrival rate or
+closed-loop with a fixed number of payments in flight. Payments between nodes without a
+direct channel are routed by the PFS. Per-payment end-to-end latency, success rate and
+throughput are written as a JSON report with latency histograms.
+
+Open-loop latency is measured from the scheduled arrival, so a saturated node shows up as
+growing latency instead of a silently lower sending rate.
+"""
+
+import asyncio
+import json
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import cycle
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+
+from prepare_channel import NodeClient, address
+from topology import Node, Topology, load_topology
+
+TIMEOUT = 120.0
+MAX_IN_FLIGHT = 256
+# upper bounds in ms, 4 per decade from 1ms to 100s, plus an overflow bucket
+HISTOGRAM_BUCKETS = [round(10 ** (exponent / 4), 1) for exponent in range(0, 21)]
+
+
+@dataclass
+class Payment:
+    initiator: str
+    target: str
+    amount: int
+    direct: bool
+    scheduled_at: float
+    latency: float = 0.0
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code == 200
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def histogram(latencies_ms: List[float]) -> Dict[str, int]:
+    counts = {f'le_{bound}': 0 for bound in HISTOGRAM_BUCKETS}
+    counts['le_inf'] = 0
+    for latency in latencies_ms:
+        for bound in HISTOGRAM_BUCKETS:
+            if latency <= bound:
+                counts[f'le_{bound}'] += 1
+                break
+        else:
+            counts['le_inf'] += 1
+    return counts
+
+
+def summarize(payments: List[Payment], elapsed: float) -> Dict[str, Any]:
+    succeeded = [payment for payment in payments if payment.ok]
+    latencies = sorted(payment.latency * 1000 for payment in succeeded)
+    failures: Dict[str, int] = {}
+    for payment in payments:
+        if not payment.ok:
+            key = str(payment.status_code) if payment.status_code else 'error'
+            failures[key] = failures.get(key, 0) + 1
+    return {
+        'payments': len(payments),
+        'succeeded': len(succeeded),
+        'success_rate': len(succeeded) / len(payments) if payments else None,
+        'throughput_per_second': len(succeeded) / elapsed if elapsed else None,
+        'failures': failures,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else None,
+            'histogram': histogram(latencies),
+        },
+    }
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        topology: Topology,
+        token: str,
+        pairs: List[Tuple[Node, Node]],
+        amounts: List[int],
+        seed: int,
+        timeout: float,
+        max_in_flight: int,
+    ):
+        self.topology = topology
+        self.token = token
+        self.pairs = pairs
+        self.amounts = amounts
+        self.rng = random.Random(seed)
+        self.max_in_flight = max_in_flight
+        # payments must not be retried, a 409 is a failed payment
+        self.clients = {node: NodeClient(timeout=timeout, retries=0) for node in topology.nodes}
+        self.addresses: Dict[Node, str] = {}
+        self.direct = {frozenset((edge.opener, edge.partner)) for edge in topology.edges}
+        self.payments: List[Payment] = []
+
+    def _pay(self, initiator: Node, target: Node, payment: Payment) -> None:
+        url = f'{initiator.api_url}payments/{self.token}/{self.addresses[target]}'
+        result = self.clients[initiator].request('POST', url, json={'amount': str(payment.amount)})
+        payment.status_code = result.status_code
+        payment.error = result.error
+        payment.latency = time.monotonic() - payment.scheduled_at
+
+    async def _send(self, initiator: Node, target: Node, scheduled_at: float) -> None:
+        payment = Payment(
+            initiator=initiator.name,
+            target=target.name,
+            amount=self.rng.choice(self.amounts),
+            direct=frozenset((initiator, target)) in self.direct,
+            scheduled_at=scheduled_at,
+        )
+        self.payments.append(payment)
+        async with self._in_flight:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._pay, initiator, target, payment)
+
+    async def open_loop(self, rate: float, duration: float, count: Optional[int]) -> None:
+        """ Poisson arrivals at ``rate`` payments per second, independent of completions """
+        start = time.monotonic()
+        next_at = start
+        tasks = []
+        for index, (initiator, target) in enumerate(cycle(self.pairs)):
+            if (count is not None and index >= count) or next_at - start >= duration:
+                break
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(self._send(initiator, target, next_at)))
+            next_at += self.rng.expovariate(rate)
+        await asyncio.gather(*tasks)
+
+    async def closed_loop(self, concurrency: int, duration: float, count: Optional[int]) -> None:
+        """ ``concurrency`` workers each sending the next payment once the last completed """
+        start = time.monotonic()
+        pairs = cycle(self.pairs)
+        sent = 0
+
+        async def worker() -> None:
+            nonlocal sent
+            while time.monotonic() - start < duration and (count is None or sent < count):
+                sent += 1
+                initiator, target = next(pairs)
+                await self._send(initiator, target, time.monotonic())
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    async def run(self, mode: str, **kwargs: Any) -> float:
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as self._executor:
+            loop = asyncio.get_running_loop()
+            nodes = self.topology.nodes
+            node_addresses = await asyncio.gather(
+                *(
+                    loop.run_in_executor(self._executor, address, self.clients[node], node)
+                    for node in nodes
+                )
+            )
+            self.addresses = dict(zip(nodes, node_addresses))
+            start = time.monotonic()
+            if mode == 'open':
+                await self.open_loop(**kwargs)
+            else:
+                await self.closed_loop(**kwargs)
+            return time.monotonic() - start
+
+    def report(self, elapsed: float, settings: Dict[str, Any]) -> Dict[str, Any]:
+        by_pair: Dict[str, List[Payment]] = {}
+        for payment in self.payments:
+            by_pair.setdefault(f'{payment.initiator}->{payment.target}', []).append(payment)
+        return {
+            'settings': settings,
+            'elapsed': elapsed,
+            'total': summarize(self.payments, elapsed),
+            'direct': summarize([p for p in self.payments if p.direct], elapsed),
+            'multi_hop': summarize([p for p in self.payments if not p.direct], elapsed),
+            'pairs': {pair: summarize(payments, elapsed) for pair, payments in by_pair.items()},
+        }
+
+
+def parse_pairs(topology: Topology, pairs: Tuple[str, ...]) -> List[Tuple[Node, Node]]:
+    by_name = {node.name: node for node in topology.nodes}
+    if not pairs:
+        return [
+            (initiator, target)
+            for initiator in topology.nodes
+            for target in topology.nodes
+            if initiator != target
+        ]
+    try:
+        return [
+            (by_name[initiator], by_name[target])
+            for initiator, _, target in (pair.partition(':') for pair in pairs)
+        ]
+    except KeyError as err:
+        raise click.BadParameter(f'Unknown node {err}', param_hint='--pair')
+
+
+@click.command()
+@click.option('--token', required=True, help='Token address to pay with')
+@click.option(
+    '--topology',
+    'topology_file',
+    type=click.Path(exists=True, dir_okay=False),
+    help='JSON topology file (see topology.py), defaults to node1 and node2',
+)
+@click.option(
+    '--pair',
+    'pairs',
+    multiple=True,
+    help='INITIATOR:TARGET node names, may be repeated [default: all ordered pairs]',
+)
+@click.option('--mode', type=click.Choice(['open', 'closed']), default='closed', show_default=True)
+@click.option('--rate', default=5.0, show_default=True, help='Payments per second (open loop)')
+@click.option('--concurrency', default=4, show_default=True, help='Payments in flight (closed)')
+@click.option('--duration', default=60.0, show_default=True, help='Seconds to send payments')
+@click.option('--count', type=int, help='Stop after this many payments')
+@click.option('--amounts', default='1,10,100', show_default=True, help='Amounts, chosen randomly')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--timeout', default=TIMEOUT, show_default=True, help='Per payment timeout in s')
+@click.option('--max-in-flight', default=MAX_IN_FLIGHT, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the JSON report here')
+def main(
+    token: str,
+    topology_file: Optional[str],
+    pairs: Tuple[str, ...],
+    mode: str,
+    rate: float,
+    concurrency: int,
+    duration: float,
+    count: Optional[int],
+    amounts: str,
+    seed: int,
+    timeout: float,
+    max_in_flight: int,
+    output: Optional[str],
+):
+    topology = load_topology(topology_file, (token,))
+    generator = LoadGenerator(
+        topology,
+        token,
+        parse_pairs(topology, pairs),
+        [int(amount) for amount in amounts.split(',')],
+        seed,
+        timeout,
+        max_in_flight,
+    )
+    if mode == 'open':
+        kwargs: Dict[str, Any] = {'rate': rate, 'duration': duration, 'count': count}
+    else:
+        kwargs = {'concurrency': concurrency, 'duration': duration, 'count': count}
+    elapsed = asyncio.run(generator.run(mode, **kwargs))
+
+    settings = {'mode': mode, 'token': token, 'amounts': amounts, 'seed': seed, **kwargs}
+    report = generator.report(elapsed, settings)
+    total = report['total']
+    latency = total['latency_ms']
+    print(
+        f"{total['succeeded']}/{total['payments']} payments succeeded in {elapsed:.1f}s, "
+        f"{total['throughput_per_second'] or 0:.2f}/s, latency ms p50 {latency['p50']} "
+        f"p90 {latency['p90']} p99 {latency['p99']}"
+    )
+    if output:
+        Path(output).write_text(json.dumps(report, indent=2))
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
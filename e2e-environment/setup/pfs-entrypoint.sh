@@ -16,6 +16,6 @@ sleep 10s
     --token-network-registry-contract-address "${TOKEN_NETWORK_REGISTRY_ADDRESS}" \
     --user-deposit-contract-address "${USER_DEPOSIT_ADDRESS}" \
     --one-to-n-contract-address "${ONE_TO_N_ADDRESS}" \
-    --matrix-server http://localhost:9080 \
+    --matrix-server "${MATRIX_SERVER:-http://localhost:9080}" \
     --log-level DEBUG \
     --log-json
@@ -1,65 +1,433 @@
 #!/usr/bin/env python
 
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
 import click
 import requests
+from urllib3.exceptions import NewConnectionError
+
+from topology import DEFAULT_AMOUNT, Edge, Node, Topology, load_topology
 
-AMOUNT = '100000000000000000000'
+AMOUNT = DEFAULT_AMOUNT
 HEADER = {'Content-Type': 'application/json', }
 
+TIMEOUT = 60.0
+RETRIES = 5
+BACKOFF = 0.5
+RETRY_STATUS_CODES = frozenset([409, 500, 502, 503, 504])
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+ROUNDS = 3
+CONCURRENCY = 16
+PER_NODE_CONCURRENCY = 1
+
+
+@dataclass
+class CallResult:
+    method: str
+    url: str
+    status_code: Optional[int]
+    latency: float
+    attempts: int
+    data: Any = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code == 200
+
+
+def not_sent(err: requests.RequestException) -> bool:
+    """ Whether a request failed before reaching the node, so it is safe to send again """
+    if isinstance(err, requests.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0] if err.args else None, 'reason', None)
+    return isinstance(reason, NewConnectionError)
+
+
+class NodeClient:
+    """ Keep-alive HTTP session to the Raiden nodes' REST API with bounded retries """
+
+    def __init__(self, timeout: float = TIMEOUT, retries: int = RETRIES, backoff: float = BACKOFF):
+        self.session = requests.Session()
+        self.session.headers.update(HEADER)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.results: List[CallResult] = []
 
-def url(port: int) -> str:
-    return f'http://localhost:{port}/api/v1/'
+    def request(self, method: str, url: str, **kwargs: Any) -> CallResult:
+        """ Retries connection errors and 5xx/409 responses with exponential backoff
 
+        Writes are only retried if they didn't reach the node. A write whose response got lost
+        may have been done, so sending it again could e.g. mint twice; see Provisioner.run.
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            status_code, data, error = None, None, None
+            sent = True
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                status_code = response.status_code
+                try:
+                    data = response.json()
+                except ValueError:
+                    data = response.text
+                if status_code != 200:
+                    error = f'HTTP {status_code}: {response.text[:200]}'
+            except (requests.ConnectionError, requests.Timeout) as err:
+                error = str(err)
+                sent = not not_sent(err)
 
-def address(port: int) -> str:
-    response = requests.get(f'http://localhost:{port}/api/v1/address')
-    return response.json()['our_address']
+            if method in IDEMPOTENT_METHODS:
+                retryable = status_code is None or status_code in RETRY_STATUS_CODES
+            else:
+                retryable = not sent
+            if status_code == 200 or not retryable or attempt > self.retries:
+                break
+            time.sleep(self.backoff * 2 ** (attempt - 1))
 
+        result = CallResult(
+            method=method,
+            url=url,
+            status_code=status_code,
+            latency=time.monotonic() - start,
+            attempts=attempt,
+            data=data,
+            error=error,
+        )
+        self.results.append(result)
+        if not result.ok:
+            print(f'{method} {url} failed after {attempt} attempt(s): {error}')
+        return result
 
-def mint(port: int, node_address: str, token: str) -> bool:
-    url = f'http://localhost:{port}/api/v1/_testing/tokens/{token}/mint'
-    data = {'to': node_address, 'value': AMOUNT, }
-    response = requests.post(url, headers=HEADER, json=data)
-    return response.status_code == 200
 
+def address(client: NodeClient, node: Node) -> str:
+    response = client.request('GET', f'{node.api_url}address')
+    if not response.ok:
+        raise click.ClickException(f'Could not get the address of {node.name}')
+    return response.data['our_address']
 
-def open_channel(port: int, token: str, partner: str) -> bool:
-    url = f'http://localhost:{port}/api/v1/channels'
+
+def mint(
+    client: NodeClient, node: Node, node_address: str, token: str, amount: str = AMOUNT
+) -> CallResult:
+    data = {'to': node_address, 'value': amount, }
+    return client.request('POST', f'{node.api_url}_testing/tokens/{token}/mint', json=data)
+
+
+def open_channel(
+    client: NodeClient, node: Node, token: str, partner: str, amount: str = AMOUNT
+) -> CallResult:
     data = {
         'partner_address': partner,
         'token_address': token,
-        'total_deposit': AMOUNT,
+        'total_deposit': amount,
     }
-    response = requests.put(url, headers=HEADER, json=data)
-    return response.status_code == 200
+    return client.request('PUT', f'{node.api_url}channels', json=data)
+
+
+def deposit(
+    client: NodeClient, node: Node, token: str, partner: str, amount: str = AMOUNT
+) -> CallResult:
+    data = {'total_deposit': amount, }
+    return client.request('PATCH', f'{node.api_url}channels/{token}/{partner}', json=data)
+
+
+def channels(client: NodeClient, node: Node) -> CallResult:
+    return client.request('GET', f'{node.api_url}channels')
+
+
+def token_balance(client: NodeClient, node: Node, token: str) -> CallResult:
+    return client.request('GET', f'{node.api_url}_testing/tokens/{token}')
+
 
+@dataclass
+class ChannelPlan:
+    edge: Edge
+    token: str
+    open: bool
+    opener_deposit: bool
+    partner_deposit: bool
 
-def deposit(port: int, token: str, partner: str) -> bool:
-    url = f'http://localhost:{port}/api/v1/channels/{token}/{partner}'
-    data = {'total_deposit': AMOUNT, }
-    response = requests.patch(url, headers=HEADER, json=data)
-    return response.status_code == 200
+
+class Provisioner:
+    """ Brings the nodes to the channels of a topology, sending only what is missing
+
+    The current channels and token balances of all nodes are queried first. Channels that
+    are already open are not opened again, deposits are only topped up where below the
+    desired amount, and nodes only get tokens minted when their balance does not cover their
+    remaining deposits. All steps run concurrently: a channel is opened once the opener's
+    mint is done, and the partner deposits once the channel is open and its own mint is
+    done. At most ``concurrency`` calls are in flight overall and ``per_node_concurrency``
+    per node.
+
+    Failed writes are not retried blindly, as they may have been done anyway. Instead, up to
+    ``rounds`` times, the state is queried again and only what is still missing is sent.
+    """
+
+    def __init__(
+        self,
+        topology: Topology,
+        concurrency: int = CONCURRENCY,
+        per_node_concurrency: int = PER_NODE_CONCURRENCY,
+        rounds: int = ROUNDS,
+        **client_kwargs: Any,
+    ):
+        self.topology = topology
+        self.concurrency = concurrency
+        self.per_node_concurrency = per_node_concurrency
+        self.rounds = rounds
+        self.backoff = client_kwargs.get('backoff', BACKOFF)
+        self.clients = {node: NodeClient(**client_kwargs) for node in topology.nodes}
+        self.addresses: Dict[Node, str] = {}
+        self.skipped: List[str] = []
+        # the failed calls of the last round
+        self.failed: List[CallResult] = []
+
+    @property
+    def results(self) -> List[CallResult]:
+        return [result for client in self.clients.values() for result in client.results]
+
+    async def _call(self, node: Node, func: Callable[..., Any], *args: Any) -> Any:
+        async with self._semaphore, self._node_semaphores[node]:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, func, self.clients[node], node, *args
+            )
+
+    async def _fetch_state(
+        self,
+    ) -> Tuple[Dict[Tuple[Node, str, str], Dict[str, Any]], Dict[Tuple[Node, str], int]]:
+        """ Returns the open channels by (node, token, partner) and balances by (node, token) """
+        nodes = self.topology.nodes
+        tokens = self.topology.tokens
+        node_channels, balances = await asyncio.gather(
+            asyncio.gather(*(self._call(node, channels) for node in nodes)),
+            asyncio.gather(
+                *(self._call(node, token_balance, token) for node in nodes for token in tokens)
+            ),
+        )
+
+        open_channels = {}
+        for node, response in zip(nodes, node_channels):
+            if not response.ok:
+                raise click.ClickException(f'Could not get the channels of {node.name}')
+            for channel in response.data:
+                if channel['state'] == 'opened':
+                    token = channel['token_address'].lower()
+                    partner = channel['partner_address'].lower()
+                    open_channels[(node, token, partner)] = channel
+
+        token_balances = {}
+        keys = [(node, token) for node in nodes for token in tokens]
+        for (node, token), response in zip(keys, balances):
+            if not response.ok:
+                raise click.ClickException(f'Could not get the {token} balance of {node.name}')
+            token_balances[(node, token)] = int(response.data['balance'])
+        return open_channels, token_balances
+
+    def _plan(
+        self,
+        open_channels: Dict[Tuple[Node, str, str], Dict[str, Any]],
+        token_balances: Dict[Tuple[Node, str], int],
+    ) -> Tuple[List[ChannelPlan], Dict[Tuple[Node, str], int]]:
+        """ Diffs the current against the desired state, returning channel steps and mints """
+        desired = int(self.topology.deposit)
+        needed: Dict[Tuple[Node, str], int] = {}
+        plans = []
+        for edge in self.topology.edges:
+            opener, partner = edge.opener, edge.partner
+            for token in self.topology.tokens:
+                own = open_channels.get((opener, token.lower(), self.addresses[partner].lower()))
+                theirs = open_channels.get(
+                    (partner, token.lower(), self.addresses[opener].lower())
+                )
+                own_deposit = int(own['total_deposit']) if own else 0
+                their_deposit = int(theirs['total_deposit']) if theirs else 0
+                plan = ChannelPlan(
+                    edge=edge,
+                    token=token,
+                    open=own is None,
+                    opener_deposit=own is not None and own_deposit < desired,
+                    partner_deposit=their_deposit < desired,
+                )
+                name = f'{opener.name} -> {partner.name} for token {token}'
+                if not plan.open:
+                    self.skipped.append(f'open channel {name}: already open')
+                    if not plan.opener_deposit:
+                        self.skipped.append(f'deposit of {opener.name} on {name}: {own_deposit}')
+                if not plan.partner_deposit:
+                    self.skipped.append(f'deposit of {partner.name} on {name}: {their_deposit}')
+                if plan.open or plan.opener_deposit:
+                    key = (opener, token)
+                    needed[key] = needed.get(key, 0) + desired - own_deposit
+                if plan.partner_deposit:
+                    key = (partner, token)
+                    needed[key] = needed.get(key, 0) + desired - their_deposit
+                plans.append(plan)
+
+        mints = {}
+        for (node, token), balance in token_balances.items():
+            missing = needed.get((node, token), 0) - balance
+            if missing > 0:
+                mint_amount = int(self.topology.mint) if self.topology.mint is not None else 0
+                mints[(node, token)] = max(missing, mint_amount)
+            else:
+                self.skipped.append(f'mint for {node.name} of token {token}: balance {balance}')
+        return plans, mints
+
+    async def _open_and_deposit(
+        self, plan: ChannelPlan, mints: Dict[Tuple[Node, str], 'asyncio.Future[Any]']
+    ) -> None:
+        opener, partner, token = plan.edge.opener, plan.edge.partner, plan.token
+        deposit_amount = self.topology.deposit
+        if plan.open or plan.opener_deposit:
+            await mints[(opener, token)]
+        if plan.open:
+            print(f'Opening channel {opener.name} -> {partner.name} for token {token}')
+            opened = await self._call(
+                opener, open_channel, token, self.addresses[partner], deposit_amount
+            )
+            if not opened.ok:
+                return
+        elif plan.opener_deposit:
+            print(f'Topping up deposit of {opener.name} on channel with {partner.name}')
+            await self._call(opener, deposit, token, self.addresses[partner], deposit_amount)
+
+        if plan.partner_deposit:
+            await mints[(partner, token)]
+            print(f'Depositing on channel {partner.name} -> {opener.name} for token {token}')
+            await self._call(partner, deposit, token, self.addresses[opener], deposit_amount)
+
+    async def run(self) -> None:
+        # asyncio primitives have to be created inside the running loop
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._node_semaphores = {
+            node: asyncio.Semaphore(self.per_node_concurrency) for node in self.topology.nodes
+        }
+        with ThreadPoolExecutor(max_workers=self.concurrency) as self._executor:
+            nodes = self.topology.nodes
+            node_addresses = await asyncio.gather(*(self._call(node, address) for node in nodes))
+            self.addresses = dict(zip(nodes, node_addresses))
+            for round_number in range(1, self.rounds + 1):
+                done = {node: len(client.results) for node, client in self.clients.items()}
+                skipped = list(self.skipped)
+                plans, mint_amounts = self._plan(*await self._fetch_state())
+                if round_number > 1:
+                    # what the previous rounds did was not in place before
+                    self.skipped = skipped
+                await self._provision(plans, mint_amounts)
+
+                self.failed = [
+                    result
+                    for node, client in self.clients.items()
+                    for result in client.results[done[node]:]
+                    if not result.ok
+                ]
+                if not self.failed or round_number == self.rounds:
+                    break
+                print(f'{len(self.failed)} call(s) failed, querying the state again')
+                await asyncio.sleep(self.backoff)
+
+    async def _provision(
+        self, plans: List[ChannelPlan], mint_amounts: Dict[Tuple[Node, str], int]
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        mints: Dict[Tuple[Node, str], 'asyncio.Future[Any]'] = {}
+        for node in self.topology.nodes:
+            for token in self.topology.tokens:
+                amount = mint_amounts.get((node, token))
+                if amount is None:
+                    mints[(node, token)] = loop.create_future()
+                    mints[(node, token)].set_result(None)
+                    continue
+                print(f'Minting {amount} {token} for {node.name} ({self.addresses[node]})')
+                mints[(node, token)] = asyncio.ensure_future(
+                    self._call(node, mint, self.addresses[node], token, str(amount))
+                )
+        await asyncio.gather(
+            *mints.values(), *(self._open_and_deposit(plan, mints) for plan in plans)
+        )
+
+
+def print_report(results: List[CallResult]) -> None:
+    print('Calls:')
+    for result in results:
+        status = 'ok' if result.ok else f'FAILED ({result.error})'
+        print(
+            f'  {result.method:<5} {result.url} {result.latency:.2f}s '
+            f'in {result.attempts} attempt(s): {status}'
+        )
 
 
 @click.command()
-@click.option('--token', required=True, type=str)
-def main(token: str):
-    print(f'Preparing channels for token {token}')
-    node1 = 5001
-    node2 = 5002
-    node1_address = address(node1)
-    node2_address = address(node2)
-
-    print(f'Minting tokens for {node1_address}')
-    mint(node1, node1_address, token)
-    print(f'Minting tokens for {node2_address}')
-    mint(node2, node2_address, token)
-
-    print(f'Opening channel from {node1_address} -> {node2_address}')
-    open_channel(node1, token, node2_address)
-    print(f'Depositing on channel {node2_address} -> {node1_address}')
-    deposit(node2, token, node1_address)
-    print('Channels ready')
+@click.option('--token', 'tokens', multiple=True, help='Token address, may be repeated')
+@click.option(
+    '--topology',
+    'topology_file',
+    type=click.Path(exists=True, dir_okay=False),
+    help='JSON topology file (see topology.py), defaults to one channel node1 -> node2',
+)
+@click.option('--concurrency', default=CONCURRENCY, show_default=True, help='Calls in flight')
+@click.option(
+    '--per-node-concurrency',
+    default=PER_NODE_CONCURRENCY,
+    show_default=True,
+    help='Calls in flight per node',
+)
+@click.option('--timeout', default=TIMEOUT, show_default=True, help='Per request timeout in s')
+@click.option('--retries', default=RETRIES, show_default=True, help='Retries per request')
+@click.option(
+    '--rounds',
+    default=ROUNDS,
+    show_default=True,
+    help='Times to query the state and send what is missing, while calls fail',
+)
+@click.option('--backoff', default=BACKOFF, show_default=True, help='Initial retry delay in s')
+def main(
+    tokens: Tuple[str, ...],
+    topology_file: Optional[str],
+    concurrency: int,
+    per_node_concurrency: int,
+    timeout: float,
+    retries: int,
+    rounds: int,
+    backoff: float,
+):
+    try:
+        topology = load_topology(topology_file, tokens)
+    except (ValueError, KeyError) as err:
+        raise click.ClickException(f'Invalid topology: {err}')
+    print(
+        f'Preparing {len(topology.edges)} channel(s) between {len(topology.nodes)} node(s) '
+        f'for token(s) {", ".join(topology.tokens)}'
+    )
+    start = time.monotonic()
+    provisioner = Provisioner(
+        topology,
+        concurrency=concurrency,
+        per_node_concurrency=per_node_concurrency,
+        rounds=rounds,
+        timeout=timeout,
+        retries=retries,
+        backoff=backoff,
+    )
+    asyncio.run(provisioner.run())
+
+    print_report(provisioner.results)
+    if provisioner.skipped:
+        print('Skipped, already in place:')
+        for step in provisioner.skipped:
+            print(f'  {step}')
+    if provisioner.failed:
+        raise click.ClickException('Preparing channels failed')
+    print(f'Channels ready after {time.monotonic() - start:.1f}s')
 
 
 if __name__ == '__main__':
@@ -5,18 +5,19 @@ source "${SMARTCONTRACTS_ENV_FILE}"
 echo Starting Chain
 ACCOUNT=$(cat /opt/deployment/miner.sh)
 
-geth --syncmode full --gcmode archive --datadir "${DATA_DIR}" \
+GETH_COMMAND="geth --syncmode full --gcmode archive --datadir ${DATA_DIR} \
   --networkid 4321 \
   --nodiscover \
   --http \
-  --http.api "eth,net,web3,txpool" \
+  --http.api eth,net,web3,txpool \
   --miner.threads 1 \
   --mine \
-  --unlock "${ACCOUNT}" \
-  --password "${PASSWORD_FILE}" \
-  --allow-insecure-unlock &
+  --unlock ${ACCOUNT} \
+  --password ${PASSWORD_FILE} \
+  --allow-insecure-unlock"
 
-GETH_PID=$!
+${GETH_COMMAND} &
+echo $! > /tmp/geth.pid
 
 source ${SERVICES_VENV}/bin/activate
 python3 -m raiden_libs.service_registry register \
@@ -29,63 +30,62 @@ python3 -m raiden_libs.service_registry register \
 deactivate
 
 synapse-entrypoint.sh &
-SYNAPSE_PID=$!
+echo $! > /tmp/synapse.pid
 
-echo Synapse server is running at "${SYNAPSE_PID}"
+echo Synapse server is running at "$(cat /tmp/synapse.pid)"
 
 echo Start PFS
 source ${SERVICES_VENV}/bin/activate
 pfs-entrypoint.sh &
+echo $! > /tmp/pfs.pid
 deactivate
-PFS_PID=$!
 
 source ${CONTRACTS_VENV}/bin/activate
-python -m raiden_contracts.deploy verify --rpc-provider http://localhost:8545 --contracts-version ${CONTRACTS_VERSION}
-
-PFS_RETRIES=0
-until $(curl --output /dev/null --silent --get --fail http://localhost:5555/api/v1/info); do
-  if [ $PFS_RETRIES -gt 10 ]; then
-    exit 1
-  fi
-  echo "Waiting for Pathfinding service to start (${PFS_RETRIES})"
-  PFS_RETRIES=$((PFS_RETRIES + 1))
-
-  sleep 20
-done
+# a predeployed chain has no deployment transactions, its contract code is verified instead
+VERIFY_OPTIONS=(--contract-version "${CONTRACTS_VERSION}" --deployment-dir /opt/deployment \
+  --env-file "${SMARTCONTRACTS_ENV_FILE}")
+if verify_predeploy.py "${VERIFY_OPTIONS[@]}" --detect; then
+  verify_predeploy.py "${VERIFY_OPTIONS[@]}"
+else
+  python -m raiden_contracts.deploy verify --rpc-provider http://localhost:8545 --contracts-version ${CONTRACTS_VERSION}
+fi
+if [[ $? -ne 0 ]]; then
+  echo 'Contract verification failed'
+  exit 1
+fi
+
+# dead services are restarted by their commands, which write the new pid to the pid file
+if ! wait_for_services.py --service eth --service matrix --service pfs \
+  --pid-file eth=/tmp/geth.pid --restart eth="${GETH_COMMAND}" \
+  --pid-file matrix=/tmp/synapse.pid --restart matrix=synapse-entrypoint.sh \
+  --pid-file pfs=/tmp/pfs.pid --restart pfs=pfs-entrypoint.sh \
+  --timeout 240; then
+  exit 1
+fi
+
+NODE1_COMMAND="/opt/raiden/raiden --keystore-path /opt/raiden/config/keys --data-dir /opt/raiden/data  --password-file /opt/raiden/config/passwd --eth-rpc-endpoint http://localhost:8545 --accept-disclaimer true --api-address 0.0.0.0:5001 --default-reveal-timeout 20 --routing-mode pfs --pathfinding-service-address http://localhost:5555 --matrix-server http://localhost:9080 --address 0x517aAD51D0e9BbeF3c64803F86b3B9136641D9ec --log-file /var/log/supervisor/node1.log --user-deposit-contract-address ${USER_DEPOSIT_ADDRESS}"
+NODE2_COMMAND="/opt/raiden/raiden --keystore-path /opt/raiden/config/keys --data-dir /opt/raiden/data  --password-file /opt/raiden/config/passwd --eth-rpc-endpoint http://localhost:8545 --accept-disclaimer true --api-address 0.0.0.0:5002 --routing-mode pfs --pathfinding-service-address http://localhost:5555 --matrix-server http://localhost:9080 --address 0xCBC49ec22c93DB69c78348C90cd03A323267db86 --log-file /var/log/supervisor/node2.log --default-reveal-timeout 20 --user-deposit-contract-address ${USER_DEPOSIT_ADDRESS}"
 
 echo Starting Node 1
-/opt/raiden/raiden --keystore-path /opt/raiden/config/keys --data-dir /opt/raiden/data  --password-file /opt/raiden/config/passwd --eth-rpc-endpoint http://localhost:8545 --accept-disclaimer true --api-address 0.0.0.0:5001 --default-reveal-timeout 20 --routing-mode pfs --pathfinding-service-address http://localhost:5555 --matrix-server http://localhost:9080 --address "0x517aAD51D0e9BbeF3c64803F86b3B9136641D9ec" --log-file = /var/log/supervisor/node1.log --user-deposit-contract-address "${USER_DEPOSIT_ADDRESS}" &
-RAIDEN1_PID=$!
+${NODE1_COMMAND} &
+echo $! > /tmp/node1.pid
 
 echo Starting Node 2
-/opt/raiden/raiden --keystore-path /opt/raiden/config/keys --data-dir /opt/raiden/data  --password-file /opt/raiden/config/passwd --eth-rpc-endpoint http://localhost:8545 --accept-disclaimer true --api-address 0.0.0.0:5002 --routing-mode pfs --pathfinding-service-address http://localhost:5555 --matrix-server http://localhost:9080 --address "0xCBC49ec22c93DB69c78348C90cd03A323267db86" --log-file /var/log/supervisor/node2.log --default-reveal-timeout 20 --user-deposit-contract-address "${USER_DEPOSIT_ADDRESS}" &
-RAIDEN2_PID=$!
-
-NODE_TRIES=0
-until $(curl --output /dev/null --silent --get --fail http://localhost:5001/api/v1/address); do
-  if [ $NODE_TRIES -gt 10 ]; then
-    echo 'Terminating'
-    exit 1
-  fi
-  echo "Waiting for node 1 (${NODE_TRIES})"
-  NODE_TRIES=$((NODE_TRIES + 1))
-  if [ ! -n "$(ps -p $RAIDEN1_PID -o pid=)" ]; then
-    echo 'restarting'
-    /opt/raiden/raiden --keystore-path /opt/raiden/config/keys --data-dir /opt/raiden/data  --password-file /opt/raiden/config/passwd --eth-rpc-endpoint http://localhost:8545 --accept-disclaimer true --api-address 0.0.0.0:5001 --routing-mode pfs --pathfinding-service-address http://localhost:5555 --matrix-server http://localhost:9080 --address "0x517aAD51D0e9BbeF3c64803F86b3B9136641D9ec" --log-file /var/log/supervisor/node1.log.json --default-reveal-timeout 20 --user-deposit-contract-address "${USER_DEPOSIT_ADDRESS}" &
-    RAIDEN1_PID=$!
-  fi
-  sleep 20
-done
-
-NODE_TRIES=0
-until $(curl --output /dev/null --silent --get --fail http://localhost:5002/api/v1/address); do
-  if [ $NODE_TRIES -gt 10 ]; then
-    exit 1
-  fi
-  echo "Waiting for node 2 (${NODE_TRIES})"
-  NODE_TRIES=$((NODE_TRIES + 1))
-  sleep 20
-done
+${NODE2_COMMAND} &
+echo $! > /tmp/node2.pid
+
+if ! wait_for_services.py --service node1 --service node2 \
+  --pid-file node1=/tmp/node1.pid --restart node1="${NODE1_COMMAND}" \
+  --pid-file node2=/tmp/node2.pid --restart node2="${NODE2_COMMAND}" \
+  --timeout 240; then
+  echo 'Terminating'
+  exit 1
+fi
+RAIDEN1_PID=$(cat /tmp/node1.pid)
+RAIDEN2_PID=$(cat /tmp/node2.pid)
+GETH_PID=$(cat /tmp/geth.pid)
+SYNAPSE_PID=$(cat /tmp/synapse.pid)
+PFS_PID=$(cat /tmp/pfs.pid)
 
 pip install click requests
 prepare_channel.py --token "${TTT_TOKEN_ADDRESS}"
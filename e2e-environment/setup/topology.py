@@ -0,0 +1,143 @@
+"""
+Channel topologies for prepare_channel.py
+
+A topology file is JSON describing the nodes, the tokens and the channels between them:
+
+    {
+        "nodes": [{"name": "node1", "port": 5001}, {"name": "node2", "port": 5002}],
+        "tokens": ["0x..."],
+        "shape": "ring",
+        "deposit": "100000000000000000000"
+    }
+
+``nodes`` can also be generated: ``{"count": 30, "base_port": 5001, "host": "localhost"}``.
+``shape`` is one of line, ring, star (the first node being the hub) or mesh (each node opens
+channels to ``degree`` random partners, chosen with ``seed``). Alternatively ``edges`` lists
+the channels explicitly as ``[opener, partner]`` pairs of node names. The opener of each
+channel deposits ``deposit`` on opening, the partner deposits afterwards. Nodes whose token
+balance doesn't cover their outstanding deposits get the missing amount minted, or ``mint``
+if that is larger.
+"""
+
+import json
+import random
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+SHAPES = ('line', 'ring', 'star', 'mesh')
+DEFAULT_AMOUNT = '100000000000000000000'
+
+
+@dataclass(frozen=True)
+class Node:
+    name: str
+    port: int
+    host: str = 'localhost'
+
+    @property
+    def api_url(self) -> str:
+        return f'http://{self.host}:{self.port}/api/v1/'
+
+
+@dataclass(frozen=True)
+class Edge:
+    opener: Node
+    partner: Node
+
+
+@dataclass
+class Topology:
+    nodes: List[Node]
+    tokens: List[str]
+    edges: List[Edge]
+    deposit: str = DEFAULT_AMOUNT
+    mint: Optional[str] = None
+
+
+def generate_edges(
+    nodes: List[Node], shape: str, degree: int = 2, seed: int = 0
+) -> List[Edge]:
+    if shape == 'line':
+        pairs = list(zip(nodes, nodes[1:]))
+    elif shape == 'ring':
+        pairs = list(zip(nodes, nodes[1:]))
+        if len(nodes) > 2:
+            pairs.append((nodes[-1], nodes[0]))
+    elif shape == 'star':
+        pairs = [(nodes[0], node) for node in nodes[1:]]
+    elif shape == 'mesh':
+        rng = random.Random(seed)
+        seen = set()
+        pairs = []
+        for node in nodes:
+            others = [other for other in nodes if other != node]
+            for partner in rng.sample(others, min(degree, len(others))):
+                key = frozenset((node.name, partner.name))
+                if key not in seen:
+                    seen.add(key)
+                    pairs.append((node, partner))
+    else:
+        raise ValueError(f'Unknown shape {shape!r}, must be one of {", ".join(SHAPES)}')
+    return [Edge(opener=opener, partner=partner) for opener, partner in pairs]
+
+
+def _parse_nodes(spec: Any) -> List[Node]:
+    if isinstance(spec, dict):
+        host = spec.get('host', 'localhost')
+        base_port = int(spec.get('base_port', 5001))
+        return [
+            Node(name=f'node{index + 1}', port=base_port + index, host=host)
+            for index in range(int(spec['count']))
+        ]
+    return [
+        Node(
+            name=node.get('name', f'node{index + 1}'),
+            port=int(node['port']),
+            host=node.get('host', 'localhost'),
+        )
+        for index, node in enumerate(spec)
+    ]
+
+
+def parse_topology(spec: Dict[str, Any], tokens: Tuple[str, ...] = ()) -> Topology:
+    nodes = _parse_nodes(spec['nodes'])
+    if len({node.name for node in nodes}) != len(nodes):
+        raise ValueError('Node names must be unique')
+
+    if 'edges' in spec:
+        by_name = {node.name: node for node in nodes}
+        edges = [
+            Edge(opener=by_name[opener], partner=by_name[partner])
+            for opener, partner in spec['edges']
+        ]
+    else:
+        edges = generate_edges(
+            nodes,
+            spec.get('shape', 'line'),
+            degree=int(spec.get('degree', 2)),
+            seed=int(spec.get('seed', 0)),
+        )
+
+    all_tokens = list(dict.fromkeys(list(spec.get('tokens', [])) + list(tokens)))
+    if not all_tokens:
+        raise ValueError('No tokens given in the topology or on the command line')
+    return Topology(
+        nodes=nodes,
+        tokens=all_tokens,
+        edges=edges,
+        deposit=str(spec.get('deposit', DEFAULT_AMOUNT)),
+        mint=str(spec['mint']) if 'mint' in spec else None,
+    )
+
+
+def load_topology(path: Optional[str], tokens: Tuple[str, ...] = ()) -> Topology:
+    """ Loads a topology file; without one, the two e2e nodes with a single channel """
+    if path is None:
+        spec: Dict[str, Any] = {
+            'nodes': [{'name': 'node1', 'port': 5001}, {'name': 'node2', 'port': 5002}],
+            'shape': 'line',
+        }
+    else:
+        spec = json.loads(Path(path).read_text())
+    return parse_topology(spec, tokens)
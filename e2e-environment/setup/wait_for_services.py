@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Waits until the services of the end-to-end environment are ready
+
+All services are probed concurrently with a short exponential backoff, and the script
+returns as soon as every one of them answers. Processes whose pid file points to a dead
+process are restarted with their restart command, and the new pid is written back to the
+pid file. A per-service startup timing report is printed (and optionally written as JSON).
+
+Only uses the standard library, as it also runs on the host in run-e2e-tests.sh:
+
+    wait_for_services.py --service pfs --service node1 \
+        --pid-file node1=/tmp/node1.pid --restart node1="/opt/raiden/raiden ..."
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+ETH_RPC_REQUEST = json.dumps(
+    {'jsonrpc': '2.0', 'method': 'eth_blockNumber', 'params': [], 'id': 1}
+).encode()
+
+# name -> (url, JSON-RPC request body or None for a GET)
+SERVICES = {
+    'eth': ('http://localhost:8545', ETH_RPC_REQUEST),
+    'matrix': ('http://localhost:9080/_matrix/client/versions', None),
+    'pfs': ('http://localhost:5555/api/v1/info', None),
+    'node1': ('http://localhost:5001/api/v1/address', None),
+    'node2': ('http://localhost:5002/api/v1/address', None),
+}
+
+TIMEOUT = 300.0
+PROBE_TIMEOUT = 2.0
+INITIAL_DELAY = 0.1
+MAX_DELAY = 5.0
+
+
+@dataclass
+class ServiceStatus:
+    name: str
+    url: str
+    ready: bool = False
+    ready_after: Optional[float] = None
+    attempts: int = 0
+    restarts: int = 0
+    last_error: Optional[str] = None
+    restart_times: List[float] = field(default_factory=list)
+
+
+def probe(url: str, body: Optional[bytes]) -> None:
+    """ Raises if the service doesn't answer successfully """
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    request = urllib.request.Request(url, data=body, headers=headers)
+    with urllib.request.urlopen(request, timeout=PROBE_TIMEOUT) as response:
+        payload = response.read()
+    if body is not None and 'result' not in json.loads(payload):
+        raise ValueError(f'Unexpected JSON-RPC response: {payload[:200]!r}')
+
+
+def process_alive(pid_file: str, process: Optional[subprocess.Popen]) -> bool:
+    if process is not None:
+        # a restarted process is our child: poll() reaps it once it died, while os.kill would
+        # still find its zombie
+        return process.poll() is None
+    try:
+        with open(pid_file) as file:
+            pid = int(file.read().strip())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def restart(command: str, pid_file: str) -> subprocess.Popen:
+    process = subprocess.Popen(command, shell=True, start_new_session=True)
+    with open(pid_file, 'w') as file:
+        file.write(str(process.pid))
+    return process
+
+
+def wait_for_service(
+    status: ServiceStatus,
+    body: Optional[bytes],
+    started_at: float,
+    deadline: float,
+    pid_file: Optional[str],
+    restart_command: Optional[str],
+    lock: threading.Lock,
+) -> ServiceStatus:
+    delay = INITIAL_DELAY
+    process: Optional[subprocess.Popen] = None
+    while True:
+        status.attempts += 1
+        try:
+            probe(status.url, body)
+        except Exception as err:
+            status.last_error = str(err)
+        else:
+            status.ready = True
+            status.ready_after = time.monotonic() - started_at
+            with lock:
+                print(f'{status.name} ready after {status.ready_after:.1f}s')
+            return status
+
+        if pid_file and restart_command and not process_alive(pid_file, process):
+            with lock:
+                print(f'{status.name} process died, restarting')
+            process = restart(restart_command, pid_file)
+            status.restarts += 1
+            status.restart_times.append(time.monotonic() - started_at)
+            delay = INITIAL_DELAY
+
+        if time.monotonic() + delay > deadline:
+            return status
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_DELAY)
+
+
+def parse_assignments(values: List[str], option: str) -> Dict[str, str]:
+    assignments = {}
+    for value in values:
+        name, separator, assigned = value.partition('=')
+        if not separator:
+            raise SystemExit(f'{option} expects NAME=VALUE, got {value!r}')
+        assignments[name] = assigned
+    return assignments
+
+
+def print_report(statuses: List[ServiceStatus], elapsed: float) -> None:
+    print(f'Startup report ({elapsed:.1f}s):')
+    for status in statuses:
+        if status.ready:
+            state = f'ready after {status.ready_after:.1f}s'
+        else:
+            state = f'NOT READY ({status.last_error})'
+        print(
+            f'  {status.name:<8} {state}, {status.attempts} probe(s), '
+            f'{status.restarts} restart(s)'
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--service',
+        action='append',
+        choices=sorted(SERVICES),
+        help='Service to wait for, may be repeated (default: all)',
+    )
+    parser.add_argument(
+        '--url',
+        action='append',
+        default=[],
+        metavar='NAME=URL',
+        help='Override the probed URL of a service',
+    )
+    parser.add_argument(
+        '--pid-file',
+        action='append',
+        default=[],
+        metavar='NAME=PATH',
+        help='File with the pid of the process running a service',
+    )
+    parser.add_argument(
+        '--restart',
+        action='append',
+        default=[],
+        metavar='NAME=COMMAND',
+        help='Command restarting a service whose process died, requires --pid-file',
+    )
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='Overall timeout in s')
+    parser.add_argument('--report', help='Write the startup report as JSON to this file')
+    args = parser.parse_args()
+
+    urls = {name: url for name, (url, _) in SERVICES.items()}
+    urls.update(parse_assignments(args.url, '--url'))
+    pid_files = parse_assignments(args.pid_file, '--pid-file')
+    restart_commands = parse_assignments(args.restart, '--restart')
+    names = args.service or list(SERVICES)
+
+    started_at = time.monotonic()
+    deadline = started_at + args.timeout
+    lock = threading.Lock()
+    statuses = [ServiceStatus(name=name, url=urls[name]) for name in names]
+    with ThreadPoolExecutor(max_workers=len(statuses)) as executor:
+        futures = [
+            executor.submit(
+                wait_for_service,
+                status,
+                SERVICES[status.name][1],
+                started_at,
+                deadline,
+                pid_files.get(status.name),
+                restart_commands.get(status.name),
+                lock,
+            )
+            for status in statuses
+        ]
+        for future in futures:
+            future.result()
+
+    elapsed = time.monotonic() - started_at
+    print_report(statuses, elapsed)
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(
+                {'elapsed': elapsed, 'services': [asdict(status) for status in statuses]},
+                file,
+                indent=2,
+            )
+    return 0 if all(status.ready for status in statuses) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
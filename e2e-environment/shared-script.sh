@@ -15,6 +15,10 @@ DEPLOYMENT_INFORMATION_VERSION_FILE="${DEPLOYMENT_INFORMATION_DIRECTORY}/version
 function finish() {
   echo -e "\nGet the log files of the run services"
   docker cp "$DOCKER_CONTAINER_NAME":/var/log/supervisor/ ./logs/ || true
+  if [[ -d ./logs ]] && command -v python3 >/dev/null; then
+    python3 "${E2E_ENVIRONMENT_DIRECTORY}/setup/log_timeline.py" analyze ./logs \
+      --output ./logs/timeline.json || true
+  fi
   echo -e "\nShut down the Docker container"
   docker stop "$DOCKER_CONTAINER_NAME" >/dev/null 2>&1 || true
 }
@@ -1,8 +1,26 @@
+import hmac
 import json
 import logging
+import time
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Any
+from typing import Any, Dict, Optional, Set
+
+from auth_metrics import AuthMetrics
+
+DEFAULT_CREDENTIALS_RELOAD_INTERVAL = 10
+
+
+def _read_credentials(credentials_file: Path) -> Dict[str, str]:
+    try:
+        credentials = json.loads(credentials_file.read_text())
+    except (JSONDecodeError, UnicodeDecodeError, OSError) as ex:
+        raise AssertionError(f"Could not read credentials file '{credentials_file}': {ex}") from ex
+
+    msg = "Keys 'username' and 'password' expected in credentials."
+    assert "username" in credentials, msg
+    assert "password" in credentials, msg
+    return credentials
 
 
 class AdminUserAuthProvider:
@@ -11,43 +29,93 @@ class AdminUserAuthProvider:
     def __init__(self, config, account_handler) -> None:  # type: ignore
         self.account_handler = account_handler
         self.log = logging.getLogger(__name__)
+        self.metrics = AuthMetrics("admin", config)
+        self.credentials_file: Optional[Path] = None
+        # the credentials file is checked for changes (one stat) at most once per interval
+        self.reload_interval = float(
+            config.get("credentials_reload_interval", DEFAULT_CREDENTIALS_RELOAD_INTERVAL)
+        )
+        self._credentials_mtime = 0.0
+        self._credentials_checked_at = 0.0
+        # admin users known to be registered, skipping check_user_exists
+        self._registered_users: Set[str] = set()
         if "credentials_file" in config:
-            credentials_file = Path(config["credentials_file"])
-            if not credentials_file.exists():
-                raise AssertionError(f"Credentials file '{credentials_file}' is missing.")
-            try:
-                self.credentials = json.loads(credentials_file.read_text())
-            except (JSONDecodeError, UnicodeDecodeError, OSError) as ex:
-                raise AssertionError(
-                    f"Could not read credentials file '{credentials_file}': {ex}"
-                ) from ex
+            self.credentials_file = Path(config["credentials_file"])
+            if not self.credentials_file.exists():
+                raise AssertionError(f"Credentials file '{self.credentials_file}' is missing.")
+            self._credentials_mtime = self.credentials_file.stat().st_mtime
+            self._credentials_checked_at = time.monotonic()
+            self.credentials = _read_credentials(self.credentials_file)
         elif "admin_credentials" in config:
             self.credentials = config["admin_credentials"]
+            msg = "Keys 'username' and 'password' expected in credentials."
+            assert "username" in self.credentials, msg
+            assert "password" in self.credentials, msg
         else:
             raise AssertionError(
                 "Either 'credentials_file' or 'admin_credentials' must be specified in "
                 "auth provider config."
             )
 
-        msg = "Keys 'username' and 'password' expected in credentials."
-        assert "username" in self.credentials, msg
-        assert "password" in self.credentials, msg
+    def _maybe_reload_credentials(self) -> None:
+        if self.credentials_file is None:
+            return
+        now = time.monotonic()
+        if now - self._credentials_checked_at < self.reload_interval:
+            return
+        self._credentials_checked_at = now
+        try:
+            mtime = self.credentials_file.stat().st_mtime
+        except OSError as ex:
+            self.log.error("Could not stat credentials file, keeping current credentials: %s", ex)
+            return
+        if mtime == self._credentials_mtime:
+            return
+        try:
+            credentials = _read_credentials(self.credentials_file)
+        except AssertionError as ex:
+            self.log.error("%s, keeping current credentials", ex)
+            return
+        self._credentials_mtime = mtime
+        if credentials["username"] != self.credentials["username"]:
+            self._registered_users.clear()
+        self.credentials = credentials
+        self.log.info("Reloaded admin user credentials from '%s'", self.credentials_file)
 
     async def check_password(self, user_id: str, password: str) -> bool:
         if not password:
             self.log.error("No password provided, user=%r", user_id)
+            self.metrics.count("bad_format")
             return False
 
+        self._maybe_reload_credentials()
         username = user_id.partition(":")[0].strip("@")
-        if username == self.credentials["username"] and password == self.credentials["password"]:
+        # compare both in constant time, and without short-circuiting on the username
+        username_ok = hmac.compare_digest(
+            username.encode(), self.credentials["username"].encode()
+        )
+        password_ok = hmac.compare_digest(
+            password.encode(), self.credentials["password"].encode()
+        )
+        if username_ok and password_ok:
             self.log.info("Logging in well known admin user")
-            user_exists = await self.account_handler.check_user_exists(user_id)
+            if user_id in self._registered_users:
+                self.metrics.count("success")
+                return True
+            with self.metrics.time("check_user_exists"):
+                user_exists = await self.account_handler.check_user_exists(user_id)
             if not user_exists:
                 self.log.info("First well known admin user login, registering: user=%r", user_id)
-                await self.account_handler._hs.get_registration_handler().register_user(
-                    localpart=username, admin=True
-                )
+                with self.metrics.time("registration"):
+                    await self.account_handler._hs.get_registration_handler().register_user(
+                        localpart=username, admin=True
+                    )
+                self.metrics.count("first_registration")
+            else:
+                self.metrics.count("success")
+            self._registered_users.add(user_id)
             return True
+        self.metrics.count("bad_credentials")
         return False
 
     @staticmethod
@@ -0,0 +1,112 @@
+# Login metrics shared by the auth providers in this directory
+
+# Counters and latency histograms are registered in prometheus_client's default registry
+# when it is installed (it is a Synapse dependency), and exposed on Synapse's metrics
+# listener once `enable_metrics: true` is set (`metrics: false` in the provider config
+# disables them). Additionally, or instead, a callback can be
+# configured in the provider config:
+#   metrics_callback: 'my_module.my_function'
+# which gets called as `my_function(provider, kind, name, value)`, with kind being
+# "count" (value 1) or "latency" (value in seconds).
+
+import importlib
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+MetricsCallback = Callable[[str, str, str, float], None]
+
+LATENCY_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+# prometheus metrics can only be registered once per process, but every provider instance
+# (and every homeserver config reload) creates a new AuthMetrics
+_PROMETHEUS_METRICS: Optional[Tuple[Any, Any]] = None
+
+
+def _get_prometheus_metrics() -> Optional[Tuple[Any, Any]]:
+    global _PROMETHEUS_METRICS
+    if prometheus_client is None:
+        return None
+    if _PROMETHEUS_METRICS is None:
+        _PROMETHEUS_METRICS = (
+            prometheus_client.Counter(
+                "synapse_auth_provider_logins",
+                "Login attempts handled by the auth providers, by outcome",
+                ["provider", "outcome"],
+            ),
+            prometheus_client.Histogram(
+                "synapse_auth_provider_stage_seconds",
+                "Time spent in each stage of a login",
+                ["provider", "stage"],
+                buckets=LATENCY_BUCKETS,
+            ),
+        )
+    return _PROMETHEUS_METRICS
+
+
+def _load_callback(path: str) -> MetricsCallback:
+    module_name, _, attribute = path.rpartition(".")
+    if not module_name:
+        raise AssertionError(f"Invalid 'metrics_callback' {path!r}, must be 'module.function'.")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+class AuthMetrics:
+    """ Login outcome counters and per stage latencies of one auth provider """
+
+    def __init__(self, provider: str, config: Dict[str, Any]) -> None:
+        self.provider = provider
+        self._prometheus = _get_prometheus_metrics() if config.get("metrics", True) else None
+        callback = config.get("metrics_callback")
+        self._callback: Optional[MetricsCallback] = (
+            _load_callback(callback) if isinstance(callback, str) else callback
+        )
+
+    def _notify(self, kind: str, name: str, value: float) -> None:
+        if self._callback is None:
+            return
+        try:
+            self._callback(self.provider, kind, name, value)
+        except Exception:  # metrics must never break logins
+            logger.exception("metrics callback failed")
+
+    def count(self, outcome: str) -> None:
+        if self._prometheus is not None:
+            self._prometheus[0].labels(self.provider, outcome).inc()
+        self._notify("count", outcome, 1)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        if self._prometheus is not None:
+            self._prometheus[1].labels(self.provider, stage).observe(seconds)
+        self._notify("latency", stage, seconds)
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
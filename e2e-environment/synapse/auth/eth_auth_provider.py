@@ -5,6 +5,22 @@
 #   - module: 'eth_auth_provider.EthAuthProvider'
 #     config:
 #       enabled: true
+#       # optional, cache of already verified login signatures
+#       signature_cache_size: 100000
+#       signature_cache_ttl: 86400  # seconds
+#       # optional, run signature recovery off the reactor thread: "thread" or "process"
+#       recover_executor: thread
+#       recover_workers: 4  # defaults to the number of CPUs
+#       recover_max_pending: 1000  # logins beyond this are rejected instead of queued
+#       # optional, users known to exist, skipping the database lookup on repeated logins
+#       known_users_cache_size: 1000000
+#       # optional, cheap rejection of repeated invalid logins
+#       failed_logins_cache_size: 100000
+#       failed_logins_cache_ttl: 600  # seconds
+#       failure_budget: 10  # failed logins per address in a fixed failure_window
+#       failure_window: 60  # seconds, one more login per window is verified past the budget
+#       # optional, see auth_metrics.py
+#       metrics_callback: 'my_module.my_function'
 
 # If desired, disable registration, to only allow auth through this provider:
 # enable_registration: false
@@ -12,17 +28,46 @@
 # user_id must be in the format: @0x<eth_address>:<homeserver>
 # password must be hex-encoded `eth_sign(<homeserver_hostname>)`
 
+import asyncio
+import contextlib
 import logging
+import os
 import re
+import time
 from binascii import unhexlify
-from typing import Any, Callable
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
 from coincurve import PublicKey
 from Crypto.Hash import keccak
 
+from auth_metrics import AuthMetrics
+
 __version__ = "0.1"
 logger = logging.getLogger(__name__)
 
+DEFAULT_SIGNATURE_CACHE_SIZE = 100_000
+DEFAULT_SIGNATURE_CACHE_TTL = 24 * 60 * 60
+DEFAULT_RECOVER_MAX_PENDING = 1000
+DEFAULT_KNOWN_USERS_CACHE_SIZE = 1_000_000
+DEFAULT_FAILED_LOGINS_CACHE_SIZE = 100_000
+DEFAULT_FAILED_LOGINS_CACHE_TTL = 10 * 60
+DEFAULT_FAILURE_BUDGET = 10
+DEFAULT_FAILURE_WINDOW = 60
+
 
 def _sha3(data: bytes) -> bytes:
     k = keccak.new(digest_bits=256)
@@ -42,11 +87,14 @@ def _eth_sign_sha3(data: bytes) -> bytes:
 
 
 def _recover(
-    data: bytes, signature: bytes, hasher: Callable[[bytes], bytes] = _eth_sign_sha3
+    data: bytes, signature: bytes, hasher: Optional[Callable[[bytes], bytes]] = _eth_sign_sha3
 ) -> bytes:
-    """ Returns account address in canonical format which signed data """
+    """ Returns account address in canonical format which signed data
+
+    If ``hasher`` is ``None``, ``data`` must already be the 32 bytes message digest.
+    """
     if len(signature) != 65:
-        logger.error("invalid signature")
+        logger.debug("invalid signature")
         return b""
     if signature[-1] >= 27:
         signature = signature[:-1] + bytes([signature[-1] - 27])
@@ -56,13 +104,195 @@ def _recover(
         ).format(compressed=False)
     except Exception as e:
         # secp256k1 is using bare Exception cls: raised if the recovery failed
-        logger.error("error while recovering pubkey: %s", e)
+        logger.debug("error while recovering pubkey: %s", e)
         return b""
 
     address = _sha3(publickey_bytes[1:])[12:]
     return address
 
 
+def _parse_login(hs_hostname: str, user_id: str, password: str) -> Optional[Tuple[bytes, bytes]]:
+    """ Returns (address, signature) of a login, or None if it is malformed
+
+    Equivalent to ``EthAuthProvider._user_re``/``_password_re``, but using plain string
+    slicing and a single ``bytes.fromhex`` per field, for bulk use.
+    """
+    if (
+        len(password) != 132
+        or not password.startswith("0x")
+        or len(user_id) != 44 + len(hs_hostname)
+        or not user_id.startswith("@0x")
+        or user_id[43] != ":"
+        or not user_id.endswith(hs_hostname)
+    ):
+        return None
+    addr_hex = user_id[3:43]
+    sig_hex = password[2:]
+    # fromhex accepts uppercase hex, the canonical format is lowercase only
+    if not (addr_hex.islower() or addr_hex.isdigit()) or not (
+        sig_hex.islower() or sig_hex.isdigit()
+    ):
+        return None
+    try:
+        return bytes.fromhex(addr_hex), bytes.fromhex(sig_hex)
+    except ValueError:
+        return None
+
+
+def _recover_batch(digest: bytes, signatures: Sequence[bytes]) -> List[bytes]:
+    """ Returns the signer addresses of many signatures over the same 32 bytes digest """
+    return [_recover(data=digest, signature=signature, hasher=None) for signature in signatures]
+
+
+def _verify_batch(
+    hs_hostname: str,
+    logins: Iterable[Tuple[str, str]],
+    digest: Optional[bytes] = None,
+) -> List[bool]:
+    """ Verifies many (user_id, password) logins for a homeserver, returning a result per item
+
+    Suitable for offline auditing of stored login signatures; ``digest`` can be passed to
+    reuse an already computed homeserver message digest.
+    """
+    if digest is None:
+        digest = _eth_sign_sha3(hs_hostname.encode())
+    parsed = [_parse_login(hs_hostname, user_id, password) for user_id, password in logins]
+    recovered = iter(_recover_batch(digest, [item[1] for item in parsed if item is not None]))
+    return [item is not None and next(recovered) == item[0] for item in parsed]
+
+
+def _make_executor(mode: Optional[str], workers: Optional[int]) -> Optional[Executor]:
+    """ Returns the executor used to offload signature recovery, or None to run it inline """
+    if not mode or mode == "inline":
+        return None
+    workers = workers or os.cpu_count() or 1
+    if mode == "thread":
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="eth-auth-recover")
+    if mode == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    raise AssertionError(
+        f"Invalid 'recover_executor' {mode!r}, must be one of 'inline', 'thread' or 'process'."
+    )
+
+
+async def _run_in_executor(
+    executor: Executor, twisted_pool: Callable[[], Any], fn: Callable[..., Any], *args: Any
+) -> Any:
+    """ Runs ``fn`` in the executor, from an asyncio loop or from Synapse's twisted reactor
+
+    Under Synapse the result is awaited following its logcontext rules, so the login keeps its
+    request context. The thread mode runs on the twisted thread pool from ``twisted_pool``
+    instead of the executor. asyncio is only used by the standalone benchmark.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        return await asyncio.wrap_future(executor.submit(fn, *args))
+
+    from synapse.logging.context import defer_to_threadpool, make_deferred_yieldable
+    from twisted.internet import defer, reactor
+
+    if isinstance(executor, ThreadPoolExecutor):
+        return await defer_to_threadpool(reactor, twisted_pool(), fn, *args)
+
+    # the futures of a process pool complete on its management thread
+    deferred: defer.Deferred = defer.Deferred()
+
+    def _done(done: "Future[Any]") -> None:
+        try:
+            result = done.result()
+        except Exception as e:
+            reactor.callFromThread(deferred.errback, e)
+        else:
+            reactor.callFromThread(deferred.callback, result)
+
+    executor.submit(fn, *args).add_done_callback(_done)
+    return await make_deferred_yieldable(deferred)
+
+
+class _AsyncioLinearizer:
+    """ Serialises by key like Synapse's ``Linearizer``, for the standalone benchmark """
+
+    def __init__(self) -> None:
+        # key -> [lock, waiters], dropped with the last waiter
+        self._flights: Dict[Hashable, List[Any]] = {}
+
+    async def queue(self, key: Hashable) -> ContextManager[None]:
+        flight = self._flights.setdefault(key, [asyncio.Lock(), 0])
+        flight[1] += 1
+        try:
+            await flight[0].acquire()
+        except BaseException:
+            self._leave(key, flight)
+            raise
+        return self._hold(key, flight)
+
+    @contextlib.contextmanager
+    def _hold(self, key: Hashable, flight: List[Any]) -> Iterator[None]:
+        try:
+            yield
+        finally:
+            flight[0].release()
+            self._leave(key, flight)
+
+    def _leave(self, key: Hashable, flight: List[Any]) -> None:
+        flight[1] -= 1
+        if not flight[1]:
+            del self._flights[key]
+
+
+def _make_linearizer() -> Any:
+    """ Returns a per key lock for the running event loop: Synapse's or asyncio's """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        from synapse.util.async_helpers import Linearizer
+
+        return Linearizer(name="eth_auth_login")
+    return _AsyncioLinearizer()
+
+
+class _LRUCache:
+    """ Bounded mapping evicting the least recently used entries
+
+    Entries older than ``ttl`` seconds are treated as missing. A ``ttl`` of ``None`` keeps
+    entries until they get evicted by size.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value, inserted_at = self._data[key]
+        except KeyError:
+            return default
+        if self.ttl is not None and time.monotonic() - inserted_at > self.ttl:
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
 class EthAuthProvider:
     __version__ = "0.1"
     _user_re = re.compile(r"^@(0x[0-9a-f]{40}):(.+)$")
@@ -73,51 +303,229 @@ class EthAuthProvider:
         self.config = config
         self.hs_hostname = self.account_handler._hs.hostname
         self.log = logging.getLogger(__name__)
+        self.metrics = AuthMetrics("eth", config)
+        # the signed message is the same for every login on this homeserver
+        self._hs_digest = _eth_sign_sha3(self.hs_hostname.encode())
+        # clients reuse the same signature on every reconnect: (user_id, signature) -> address
+        self._recovered_cache = _LRUCache(
+            maxsize=int(config.get("signature_cache_size", DEFAULT_SIGNATURE_CACHE_SIZE)),
+            ttl=float(config.get("signature_cache_ttl", DEFAULT_SIGNATURE_CACHE_TTL)),
+        )
+        self._recover_workers = int(config.get("recover_workers") or os.cpu_count() or 1)
+        self._executor = _make_executor(config.get("recover_executor"), self._recover_workers)
+        # the thread mode under Synapse, see _run_in_executor
+        self._twisted_pool: Any = None
+        self._max_pending = int(config.get("recover_max_pending", DEFAULT_RECOVER_MAX_PENDING))
+        self._pending_recoveries = 0
+        # users only ever get created, so a positive lookup never has to be repeated
+        self._known_users = _LRUCache(
+            maxsize=int(config.get("known_users_cache_size", DEFAULT_KNOWN_USERS_CACHE_SIZE))
+        )
+        # by user_id: concurrent logins of a user run one after another, so followers hit
+        # the caches filled by the first instead of registering again
+        self._login_linearizer: Any = None
+        # (user_id, password) pairs which recently failed, rejected without recovery
+        self._failed_logins = _LRUCache(
+            maxsize=int(config.get("failed_logins_cache_size", DEFAULT_FAILED_LOGINS_CACHE_SIZE)),
+            ttl=float(config.get("failed_logins_cache_ttl", DEFAULT_FAILED_LOGINS_CACHE_TTL)),
+        )
+        # address -> [failed logins, recovery login left], for a fixed window from the first
+        # failure: updated in place, so further failures don't extend the window
+        self._failure_budget = int(config.get("failure_budget", DEFAULT_FAILURE_BUDGET))
+        self._failures = _LRUCache(
+            maxsize=int(config.get("failed_logins_cache_size", DEFAULT_FAILED_LOGINS_CACHE_SIZE)),
+            ttl=float(config.get("failure_window", DEFAULT_FAILURE_WINDOW)),
+        )
 
     async def check_password(self, user_id: str, password: str) -> bool:
+        # rejected logins are only logged at debug level, as a login storm would flood the log,
+        # the metrics count them by reason
         if not password:
-            self.log.error("no password provided, user=%r", user_id)
-            return False
-
-        if not self._password_re.match(password):
-            self.log.error(
-                "invalid password format, must be 0x-prefixed hex, "
-                "lowercase, 65-bytes hash. user=%r",
-                user_id,
-            )
+            self.log.debug("no password provided, user=%r", user_id)
+            self.metrics.count("bad_format")
             return False
 
-        signature = unhexlify(password[2:])
-
+        parse_start = time.perf_counter()
         user_match = self._user_re.match(user_id)
+        password_match = self._password_re.match(password)
+        self.metrics.observe("parse", time.perf_counter() - parse_start)
+
         if not user_match or user_match.group(2) != self.hs_hostname:
-            self.log.error(
+            self.log.debug(
                 "invalid user format, must start with 0x-prefixed hex, "
                 "lowercase address. user=%r",
                 user_id,
             )
+            self.metrics.count("bad_hostname" if user_match else "bad_format")
+            return False
+
+        if not password_match:
+            self.log.debug(
+                "invalid password format, must be 0x-prefixed hex, "
+                "lowercase, 65-bytes hash. user=%r",
+                user_id,
+            )
+            self.metrics.count("bad_format")
+            return False
+
+        if self._failed_logins.get((user_id, password)):
+            self.log.debug("repeated invalid login, rejecting. user=%r", user_id)
+            self.metrics.count("bad_signature_cached")
             return False
 
         user_addr_hex = user_match.group(1)
+        signature = unhexlify(password[2:])
         user_addr = unhexlify(user_addr_hex[2:])
 
-        rec_addr = _recover(data=self.hs_hostname.encode(), signature=signature)
+        # an already verified signature stays usable, and junk logins can't lock users out for
+        # longer than a window, in which one login is still verified past the budget
+        verified = self._recovered_cache.get((user_id, signature)) == user_addr
+        if not verified and not self._within_failure_budget(user_addr_hex):
+            self.log.debug("failure budget exhausted, rejecting login. user=%r", user_id)
+            self.metrics.count("failure_budget_exhausted")
+            return False
+
+        if self._login_linearizer is None:
+            self._login_linearizer = _make_linearizer()
+        with (await self._login_linearizer.queue(user_id)):
+            return await self._login(user_id, user_addr, signature)
+
+    def _within_failure_budget(self, user_addr_hex: str) -> bool:
+        failures = self._failures.get(user_addr_hex)
+        if failures is None or failures[0] < self._failure_budget:
+            return True
+        if failures[1]:
+            failures[1] = False
+            self.metrics.count("failure_budget_recovery")
+            return True
+        return False
+
+    def _record_failure(self, user_addr_hex: str) -> None:
+        failures = self._failures.get(user_addr_hex)
+        if failures is None:
+            self._failures.set(user_addr_hex, [1, True])
+        else:
+            failures[0] += 1
+
+    async def _login(self, user_id: str, user_addr: bytes, signature: bytes) -> bool:
+        rec_addr = await self._recover_cached(user_id, signature)
+        if rec_addr is None:
+            return False
         if not rec_addr or rec_addr != user_addr:
-            self.log.error(
+            self.log.debug(
                 "invalid account password/signature. user=%r, signer=%r", user_id, rec_addr
             )
+            self._failed_logins.set((user_id, "0x" + signature.hex()), True)
+            self._record_failure("0x" + user_addr.hex())
+            self.metrics.count("bad_signature")
             return False
 
         localpart = user_id.split(":", 1)[0][1:]
         self.log.info("eth login! valid signature. user=%r", user_id)
 
-        if not (await self.account_handler.check_user_exists(user_id)):
+        if self._known_users.get(user_id):
+            self.metrics.count("success")
+            return True
+
+        with self.metrics.time("check_user_exists"):
+            user_exists = await self.account_handler.check_user_exists(user_id)
+        if not user_exists:
             self.log.info("First login, creating new user: user=%r", user_id)
-            registered_user_id = await self.account_handler.register_user(localpart=localpart)
-            await self.account_handler.register_device(registered_user_id, device_id="raiden")
+            with self.metrics.time("registration"):
+                registered_user_id = await self.account_handler.register_user(localpart=localpart)
+                await self.account_handler.register_device(registered_user_id, device_id="raiden")
+            self.metrics.count("first_registration")
+        else:
+            self.metrics.count("success")
+        self._known_users.set(user_id, True)
 
         return True
 
+    async def verify_batch(self, logins: Sequence[Tuple[str, str]]) -> List[bool]:
+        """ Verifies many (user_id, password) logins at once, returning a result per item
+
+        Intended for bulk re-authentication. Signatures already in the cache are not
+        recovered again, the rest is recovered in one call (in the executor, if configured).
+        """
+        results = [False] * len(logins)
+        pending: List[Tuple[int, bytes, Tuple[str, bytes]]] = []
+        for index, (user_id, password) in enumerate(logins):
+            parsed = _parse_login(self.hs_hostname, user_id, password)
+            if parsed is None:
+                continue
+            user_addr, signature = parsed
+            cache_key = (user_id, signature)
+            rec_addr = self._recovered_cache.get(cache_key)
+            if rec_addr is None:
+                pending.append((index, user_addr, cache_key))
+            else:
+                results[index] = rec_addr == user_addr
+
+        if not pending:
+            return results
+        signatures = [cache_key[1] for _, _, cache_key in pending]
+        if self._executor is None:
+            recovered = _recover_batch(self._hs_digest, signatures)
+        else:
+            recovered = await _run_in_executor(
+                self._executor, self._get_twisted_pool, _recover_batch, self._hs_digest, signatures
+            )
+        for (index, user_addr, cache_key), rec_addr in zip(pending, recovered):
+            if rec_addr:
+                self._recovered_cache.set(cache_key, rec_addr)
+            results[index] = rec_addr == user_addr
+        return results
+
+    async def _recover_cached(self, user_id: str, signature: bytes) -> Optional[bytes]:
+        """ Returns the signer address, or None if the login was pushed back due to load """
+        cache_key = (user_id, signature)
+        rec_addr = self._recovered_cache.get(cache_key)
+        if rec_addr is not None:
+            return rec_addr
+
+        if self._executor is None:
+            with self.metrics.time("recover"):
+                rec_addr = _recover(data=self._hs_digest, signature=signature, hasher=None)
+        else:
+            if self._pending_recoveries >= self._max_pending:
+                self.log.debug(
+                    "too many pending signature recoveries (%d), rejecting login. user=%r",
+                    self._pending_recoveries,
+                    user_id,
+                )
+                self.metrics.count("pushed_back")
+                return None
+            self._pending_recoveries += 1
+            try:
+                with self.metrics.time("recover"):
+                    rec_addr = await _run_in_executor(
+                        self._executor,
+                        self._get_twisted_pool,
+                        _recover,
+                        self._hs_digest,
+                        signature,
+                        None,
+                    )
+            finally:
+                self._pending_recoveries -= 1
+
+        if rec_addr:
+            self._recovered_cache.set(cache_key, rec_addr)
+        return rec_addr
+
+    def _get_twisted_pool(self) -> Any:
+        """ A twisted thread pool as large as the executor, started on first use """
+        if self._twisted_pool is None:
+            from twisted.internet import reactor
+            from twisted.python.threadpool import ThreadPool
+
+            self._twisted_pool = ThreadPool(
+                minthreads=1, maxthreads=self._recover_workers, name="eth-auth-recover"
+            )
+            self._twisted_pool.start()
+            reactor.addSystemEventTrigger("during", "shutdown", self._twisted_pool.stop)
+        return self._twisted_pool
+
     @staticmethod
     def parse_config(config: Any) -> Any:
         return config
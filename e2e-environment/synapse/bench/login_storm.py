@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Login storm benchmark for the eth auth provider
+
+Drives ``EthAuthProvider.check_password`` concurrently with asyncio against an in-memory
+fake account handler, no Synapse or network required. Requires coincurve, pycryptodome
+and click, as installed in the Synapse venv of the image.
+
+    python login_storm.py --users 2000 --concurrency 200
+    python login_storm.py --provider-config '{"recover_executor": "process"}' --json
+"""
+
+import asyncio
+import json
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+from coincurve import PrivateKey
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "auth"))
+
+from eth_auth_provider import EthAuthProvider, _eth_sign_sha3, _sha3  # noqa: E402
+
+HOSTNAME = "localhost:9080"
+SCENARIOS = ("cold", "warm", "invalid", "mixed")
+
+Login = Tuple[str, str]
+
+
+class FakeHomeserver:
+    hostname = HOSTNAME
+
+
+class FakeAccountHandler:
+    """ Mimics the parts of Synapse's ModuleApi used by the provider, with a fixed DB delay """
+
+    def __init__(self, db_latency: float) -> None:
+        self._hs = FakeHomeserver()
+        self.db_latency = db_latency
+        self.users: set = set()
+        self.lookups = 0
+        self.registrations = 0
+
+    async def check_user_exists(self, user_id: str) -> bool:
+        self.lookups += 1
+        await asyncio.sleep(self.db_latency)
+        return user_id in self.users
+
+    async def register_user(self, localpart: str, **_kwargs: Any) -> str:
+        self.registrations += 1
+        await asyncio.sleep(self.db_latency)
+        user_id = f"@{localpart}:{self._hs.hostname}"
+        self.users.add(user_id)
+        return user_id
+
+    async def register_device(self, user_id: str, device_id: str) -> None:
+        await asyncio.sleep(self.db_latency)
+
+
+def generate_logins(count: int, seed: int, hostname: str = HOSTNAME) -> List[Login]:
+    """ Deterministic (user_id, password) pairs, as sent by Raiden clients """
+    digest = _eth_sign_sha3(hostname.encode())
+    logins = []
+    for index in range(count):
+        private_key = PrivateKey(_sha3(b"%d:%d" % (seed, index)))
+        address = _sha3(private_key.public_key.format(compressed=False)[1:])[12:]
+        signature = private_key.sign_recoverable(digest, hasher=None)
+        signature = signature[:-1] + bytes([signature[-1] + 27])
+        logins.append((f"@0x{address.hex()}:{hostname}", f"0x{signature.hex()}"))
+    return logins
+
+
+def invalid_logins(logins: List[Login]) -> List[Login]:
+    """ Valid user ids with a signature of another key """
+    return [(user_id, logins[index - 1][1]) for index, (user_id, _) in enumerate(logins)]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def drive(
+    provider: EthAuthProvider, logins: List[Login], concurrency: int
+) -> Dict[str, Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    accepted = 0
+
+    async def login(user_id: str, password: str) -> None:
+        nonlocal accepted
+        async with semaphore:
+            start = time.perf_counter()
+            if await provider.check_password(user_id, password):
+                accepted += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(login(user_id, password) for user_id, password in logins))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "logins": len(logins),
+        "accepted": accepted,
+        "seconds": elapsed,
+        "logins_per_second": len(logins) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": latencies[-1] * 1000 if latencies else 0.0,
+        },
+    }
+
+
+async def run_scenario(
+    scenario: str,
+    logins: List[Login],
+    concurrency: int,
+    db_latency: float,
+    provider_config: Dict[str, Any],
+) -> Dict[str, Any]:
+    account_handler = FakeAccountHandler(db_latency)
+    provider = EthAuthProvider(dict(provider_config), account_handler)
+
+    if scenario == "cold":
+        traffic = logins
+    elif scenario == "warm":
+        # users registered and signatures seen by this homeserver process before
+        await drive(provider, logins, concurrency)
+        account_handler.lookups = account_handler.registrations = 0
+        traffic = logins
+    elif scenario == "invalid":
+        traffic = invalid_logins(logins)
+    elif scenario == "mixed":
+        # a third reconnecting, a third new, a third junk
+        third = len(logins) // 3
+        await drive(provider, logins[:third], concurrency)
+        account_handler.lookups = account_handler.registrations = 0
+        traffic = [
+            login
+            for triple in zip(
+                logins[:third], logins[third : 2 * third], invalid_logins(logins[2 * third :])
+            )
+            for login in triple
+        ]
+    else:
+        raise click.BadParameter(f"Unknown scenario {scenario!r}")
+
+    result = await drive(provider, traffic, concurrency)
+    result["scenario"] = scenario
+    result["db_lookups"] = account_handler.lookups
+    result["registrations"] = account_handler.registrations
+    return result
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    latency = result["latency_ms"]
+    print(
+        f"{result['scenario']:>8}: {result['logins']:>7} logins "
+        f"({result['accepted']} accepted) in {result['seconds']:.3f}s = "
+        f"{result['logins_per_second']:>9.1f}/s | latency ms "
+        f"p50 {latency['p50']:.3f} p95 {latency['p95']:.3f} p99 {latency['p99']:.3f} "
+        f"max {latency['max']:.3f} | db lookups {result['db_lookups']}, "
+        f"registrations {result['registrations']}"
+    )
+
+
+@click.command()
+@click.option("--users", default=1000, show_default=True, help="Number of distinct users")
+@click.option("--concurrency", default=100, show_default=True, help="Concurrent logins")
+@click.option("--seed", default=0, show_default=True, help="Seed of the generated keys")
+@click.option(
+    "--scenario",
+    "scenarios",
+    type=click.Choice(SCENARIOS),
+    multiple=True,
+    help="Scenario to run, may be repeated [default: all]",
+)
+@click.option(
+    "--db-latency-ms", default=0.5, show_default=True, help="Simulated database round trip"
+)
+@click.option("--provider-config", default="{}", help="JSON config passed to EthAuthProvider")
+@click.option("--json", "as_json", is_flag=True, help="Print the results as JSON")
+@click.option("--output", type=click.Path(dir_okay=False), help="Also write JSON results here")
+def main(
+    users: int,
+    concurrency: int,
+    seed: int,
+    scenarios: Tuple[str, ...],
+    db_latency_ms: float,
+    provider_config: str,
+    as_json: bool,
+    output: Optional[str],
+) -> None:
+    logging.basicConfig(level=logging.WARNING)
+    config = json.loads(provider_config)
+
+    generation_start = time.perf_counter()
+    logins = generate_logins(users, seed)
+    if not as_json:
+        print(f"Generated {users} logins in {time.perf_counter() - generation_start:.2f}s")
+
+    results = []
+    for scenario in scenarios or SCENARIOS:
+        result = asyncio.run(
+            run_scenario(scenario, logins, concurrency, db_latency_ms / 1000, config)
+        )
+        results.append(result)
+        if not as_json:
+            print_result(result)
+
+    report = {
+        "users": users,
+        "concurrency": concurrency,
+        "seed": seed,
+        "db_latency_ms": db_latency_ms,
+        "provider_config": config,
+        "results": results,
+    }
+    if as_json:
+        print(json.dumps(report, indent=2))
+    if output:
+        Path(output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,76 +1,726 @@
+import ipaddress
 import json
 import os
 import random
+import shutil
+import socket
 import string
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, Dict, List
 from eth_typing import ChecksumAddress
 from eth_utils import to_checksum_address
 
-PATH_CONFIG = Path("/opt/synapse/config/synapse.yaml")
+PATH_CONFIG_DIR = Path("/opt/synapse/config")
+PATH_DATA_DIR = Path("/opt/synapse/data")
+PATH_WELL_KNOWN_DIR = Path("/opt/synapse/data_well_known")
+PATH_CONFIG = PATH_CONFIG_DIR / "synapse.yaml"
 PATH_CONFIG_TEMPLATE = Path("/opt/synapse/config/synapse.template.yaml")
-PATH_MACAROON_KEY = Path("/opt/synapse/data/keys/macaroon.key")
-PATH_ADMIN_USER_CREDENTIALS = Path("/opt/synapse/config/admin_user_cred.json")
 PATH_KNOWN_FEDERATION_SERVERS = Path("/opt/synapse/data/known_federation_servers.yaml")
-PATH_WELL_KNOWN_FILE = Path("/opt/synapse/data_well_known/server")
+PATH_LOG_CONFIG = PATH_CONFIG_DIR / "synapse.log.config"
+# the additional homeservers of a cluster, the first one uses the paths above
+PATH_CLUSTER_SERVERS = Path("/opt/synapse/servers")
+PATH_CLUSTER_TLS_CERTIFICATE = PATH_CLUSTER_SERVERS / "federation.tls.crt"
+PATH_CLUSTER_TLS_PRIVATE_KEY = PATH_CLUSTER_SERVERS / "federation.tls.key"
+# where the Raiden nodes and the PFS of the image find their homeserver, see entrypoint.sh
+PATH_MATRIX_SERVER_ENV_FILE = PATH_CONFIG_DIR / "matrix_server.sh"
+PATH_SUPERVISORD_CLUSTER = Path("/etc/supervisor/conf.d/synapse-cluster.conf")
+PATH_SYNAPSE_ENTRYPOINT = Path("/usr/local/bin/synapse-entrypoint.sh")
+PATH_WORKER_CONFIGS = Path("/opt/synapse/config/workers")
+PATH_WORKER_ROUTES = Path("/opt/synapse/config/workers/routes.json")
+PATH_SUPERVISORD_WORKERS = Path("/etc/supervisor/conf.d/synapse-workers.conf")
+PATH_SYNAPSE_PYTHON = Path("/opt/synapse/venv/bin/python")
+PATH_SUPERVISOR_LOGS = Path("/var/log/supervisor")
 
+MAIN_PROCESS_LISTENER = "127.0.0.1:9080"
+HTTP_PORT = 9080
+METRICS_PORT = 9101
+REPLICATION_TCP_PORT = 9092
+REPLICATION_HTTP_PORT = 9093
+FEDERATION_PORT = 8448
+# the ports of the n-th homeserver of a cluster are offset by n times this
+CLUSTER_PORT_STRIDE = 100
+WORKER_BASE_PORT = 8100
+# Paths a generic worker can serve, from the Synapse worker documentation. Everything else
+# goes to the main process. Workers are assigned the roles in this order, so a single worker
+# takes the /sync load of the light clients.
+WORKER_ROUTES: Dict[str, List[str]] = {
+    "sync": [
+        "^/_matrix/client/(v2_alpha|r0)/sync$",
+        "^/_matrix/client/(api/v1|v2_alpha|r0)/events$",
+        "^/_matrix/client/(api/v1|r0)/initialSync$",
+        "^/_matrix/client/(api/v1|r0)/rooms/[^/]+/initialSync$",
+    ],
+    "client": [
+        "^/_matrix/client/(api/v1|r0|unstable)/login$",
+        "^/_matrix/client/(api/v1|r0|unstable)/publicRooms$",
+        "^/_matrix/client/(api/v1|r0|unstable)/rooms/.*/joined_members$",
+        "^/_matrix/client/(api/v1|r0|unstable)/rooms/.*/context/.*$",
+        "^/_matrix/client/(api/v1|r0|unstable)/rooms/.*/members$",
+        "^/_matrix/client/(api/v1|r0|unstable)/rooms/.*/state$",
+        "^/_matrix/client/(api/v1|r0|unstable)/rooms/.*/event/",
+        "^/_matrix/client/(api/v1|r0|unstable)/rooms/.*/send",
+        "^/_matrix/client/(api/v1|r0|unstable)/rooms/.*/state/",
+        "^/_matrix/client/(api/v1|r0|unstable)/rooms/.*/(join|invite|leave|ban|unban|kick)$",
+        "^/_matrix/client/(api/v1|r0|unstable)/join/",
+        "^/_matrix/client/(api/v1|r0|unstable)/joined_rooms$",
+        "^/_matrix/client/(api/v1|r0|unstable)/profile/",
+        "^/_matrix/client/(api/v1|r0|unstable)/keys/query$",
+        "^/_matrix/client/(api/v1|r0|unstable)/keys/changes$",
+        "^/_matrix/client/(api/v1|r0|unstable)/search$",
+        "^/_matrix/client/versions$",
+    ],
+    "federation": [
+        "^/_matrix/federation/v1/send/",
+        "^/_matrix/federation/v1/event/",
+        "^/_matrix/federation/v1/state/",
+        "^/_matrix/federation/v1/state_ids/",
+        "^/_matrix/federation/v1/backfill/",
+        "^/_matrix/federation/v1/get_missing_events/",
+        "^/_matrix/federation/v1/query/",
+        "^/_matrix/federation/v1/make_join/",
+        "^/_matrix/federation/v1/make_leave/",
+        "^/_matrix/federation/(v1|v2)/send_join/",
+        "^/_matrix/federation/(v1|v2)/send_leave/",
+        "^/_matrix/federation/(v1|v2)/invite/",
+        "^/_matrix/federation/v1/event_auth/",
+        "^/_matrix/federation/v1/user/devices/",
+        "^/_matrix/key/v2/query",
+    ],
+}
 
-def get_macaroon_key() -> str:
-    if not PATH_MACAROON_KEY.exists():
+DEFAULT_PERFORMANCE_PROFILE = "default"
+# Settings deciding the homeserver throughput, selected by SYNAPSE_PERFORMANCE_PROFILE. Each
+# one can be overridden by an environment variable of the same name prefixed with SYNAPSE_,
+# e.g. SYNAPSE_EVENT_CACHE_SIZE=50K.
+PERFORMANCE_PROFILES: Dict[str, Dict[str, Any]] = {
+    "default": {
+        "EVENT_CACHE_SIZE": "20K",
+        "CACHE_FACTOR": 0.5,
+        "RC_MESSAGE_PER_SECOND": 15,
+        "RC_MESSAGE_BURST_COUNT": 100,
+        "RC_LOGIN_PER_SECOND": 1,
+        "RC_LOGIN_BURST_COUNT": 10,
+        "RC_FEDERATION_WINDOW_SIZE": 1000,
+        "RC_FEDERATION_SLEEP_LIMIT": 50,
+        "RC_FEDERATION_SLEEP_DELAY": 250,
+        "RC_FEDERATION_REJECT_LIMIT": 50,
+        "RC_FEDERATION_CONCURRENT": 1,
+        "DATABASE_CP_MIN": 5,
+        "DATABASE_CP_MAX": 10,
+    },
+    # many clients logging in and messaging at once, rate limits out of the way
+    "load-test": {
+        "EVENT_CACHE_SIZE": "200K",
+        "CACHE_FACTOR": 2.0,
+        "RC_MESSAGE_PER_SECOND": 1000,
+        "RC_MESSAGE_BURST_COUNT": 10000,
+        "RC_LOGIN_PER_SECOND": 1000,
+        "RC_LOGIN_BURST_COUNT": 10000,
+        "RC_FEDERATION_WINDOW_SIZE": 1000,
+        "RC_FEDERATION_SLEEP_LIMIT": 1000,
+        "RC_FEDERATION_SLEEP_DELAY": 10,
+        "RC_FEDERATION_REJECT_LIMIT": 1000,
+        "RC_FEDERATION_CONCURRENT": 10,
+        "DATABASE_CP_MIN": 10,
+        "DATABASE_CP_MAX": 40,
+    },
+    # small caches and few database connections, e.g. for CI machines
+    "low-memory": {
+        "EVENT_CACHE_SIZE": "5K",
+        "CACHE_FACTOR": 0.1,
+        "RC_MESSAGE_PER_SECOND": 15,
+        "RC_MESSAGE_BURST_COUNT": 100,
+        "RC_LOGIN_PER_SECOND": 1,
+        "RC_LOGIN_BURST_COUNT": 10,
+        "RC_FEDERATION_WINDOW_SIZE": 1000,
+        "RC_FEDERATION_SLEEP_LIMIT": 50,
+        "RC_FEDERATION_SLEEP_DELAY": 250,
+        "RC_FEDERATION_REJECT_LIMIT": 50,
+        "RC_FEDERATION_CONCURRENT": 1,
+        "DATABASE_CP_MIN": 1,
+        "DATABASE_CP_MAX": 3,
+    },
+}
+
+
+@dataclass
+class Homeserver:
+    """
+    Name, directories and ports of a homeserver. A single homeserver has no federation
+    listener. In a cluster every server federates over TLS on the port in its name, which
+    makes other servers connect there directly instead of looking up a well-known file.
+    Clients derive the server name from the URL they connect to, so this port serves the
+    client API as well.
+    """
+
+    server_name: str
+    config_dir: Path
+    data_dir: Path
+    well_known_dir: Path
+    port_offset: int = 0
+    federates: bool = False
+    postgres_database: str = "synapse"
+
+    @property
+    def config(self) -> Path:
+        return self.config_dir / "synapse.yaml"
+
+    @property
+    def macaroon_key(self) -> Path:
+        return self.data_dir / "keys" / "macaroon.key"
+
+    @property
+    def signing_key(self) -> Path:
+        return self.data_dir / "keys" / "synapse-signing.key"
+
+    @property
+    def tls_certificate(self) -> Path:
+        return PATH_CLUSTER_TLS_CERTIFICATE
+
+    @property
+    def tls_private_key(self) -> Path:
+        return PATH_CLUSTER_TLS_PRIVATE_KEY
+
+    @property
+    def tls_port(self) -> int:
+        return int(self.server_name.rsplit(":", 1)[1])
+
+    @property
+    def client_url(self) -> str:
+        if self.federates:
+            return f"https://{self.server_name}"
+        return f"http://localhost:{self.ports['HTTP_PORT']}"
+
+    @property
+    def admin_credentials(self) -> Path:
+        return self.config_dir / "admin_user_cred.json"
+
+    @property
+    def well_known_file(self) -> Path:
+        return self.well_known_dir / "server"
+
+    @property
+    def sqlite_database(self) -> Path:
+        return self.data_dir / "homeserver.db"
+
+    @property
+    def ports(self) -> Dict[str, int]:
+        return {
+            "HTTP_PORT": HTTP_PORT + self.port_offset,
+            "METRICS_PORT": METRICS_PORT + self.port_offset,
+            "REPLICATION_TCP_PORT": REPLICATION_TCP_PORT + self.port_offset,
+            "REPLICATION_HTTP_PORT": REPLICATION_HTTP_PORT + self.port_offset,
+        }
+
+
+def plan_homeservers(count: int, server_name: str, host: str) -> List[Homeserver]:
+    """
+    The single homeserver named ``server_name``, or a cluster of ``count`` homeservers on
+    ``host``, named after their federation ports.
+    """
+    postgres_database = os.environ.get("POSTGRES_DB", "synapse")
+    if count == 1:
+        return [
+            Homeserver(
+                server_name,
+                PATH_CONFIG_DIR,
+                PATH_DATA_DIR,
+                PATH_WELL_KNOWN_DIR,
+                postgres_database=postgres_database,
+            )
+        ]
+    homeservers = []
+    for index in range(count):
+        offset = index * CLUSTER_PORT_STRIDE
+        base_dir = PATH_CLUSTER_SERVERS / f"server{index + 1}"
+        homeservers.append(
+            Homeserver(
+                server_name=f"{host}:{FEDERATION_PORT + offset}",
+                config_dir=base_dir / "config" if index else PATH_CONFIG_DIR,
+                data_dir=base_dir / "data" if index else PATH_DATA_DIR,
+                well_known_dir=base_dir / "data_well_known" if index else PATH_WELL_KNOWN_DIR,
+                port_offset=offset,
+                federates=True,
+                postgres_database=(
+                    f"{postgres_database}{index + 1}" if index else postgres_database
+                ),
+            )
+        )
+    return homeservers
+
+
+def get_macaroon_key(server: Homeserver) -> str:
+    if not server.macaroon_key.exists():
+        server.macaroon_key.parent.mkdir(parents=True, exist_ok=True)
         alphabet = string.digits + string.ascii_letters + "!@#$%^&*()_-=+{}[]"
         macaroon = "".join(random.choice(alphabet) for _ in range(30))
-        PATH_MACAROON_KEY.write_text(macaroon)
+        server.macaroon_key.write_text(macaroon)
     else:
-        macaroon = PATH_MACAROON_KEY.read_text()
+        macaroon = server.macaroon_key.read_text()
     return macaroon
 
 
+def generate_tls_certificate(server: Homeserver) -> None:
+    """
+    Generate a self-signed certificate for the TLS listener. All servers of a cluster share
+    the host and this certificate, so clients have a single one to trust. The servers don't
+    verify each other's certificates, so this is only fit for local tests.
+    """
+    if server.tls_certificate.exists():
+        return
+    # part of the Synapse venv, but only needed for clusters
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+    from datetime import datetime, timedelta
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    host = server.server_name.rsplit(":", 1)[0]
+    try:
+        alternative_name: x509.GeneralName = x509.IPAddress(ipaddress.ip_address(host))
+    except ValueError:
+        alternative_name = x509.DNSName(host)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    now = datetime.utcnow()
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=3650))
+        .add_extension(x509.SubjectAlternativeName([alternative_name]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    server.tls_private_key.parent.mkdir(parents=True, exist_ok=True)
+    server.tls_private_key.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption(),
+        )
+    )
+    server.tls_certificate.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+
+
+def get_performance_profile(name: str) -> Dict[str, Any]:
+    if name not in PERFORMANCE_PROFILES:
+        raise ValueError(
+            f"Unknown performance profile {name!r}, use one of {', '.join(PERFORMANCE_PROFILES)}"
+        )
+    return {
+        key: os.environ.get(f"SYNAPSE_{key}", value)
+        for key, value in PERFORMANCE_PROFILES[name].items()
+    }
+
+
+def render_database_config(server: Homeserver, profile: Dict[str, Any]) -> str:
+    """
+    Render the ``database`` section. Postgres is used with a connection pool sized by the
+    profile if ``POSTGRES_HOST`` is set, sqlite otherwise. Synapse always uses a single sqlite
+    connection and sets the sqlite pragmas itself, so there is nothing to tune for sqlite.
+    """
+    if "POSTGRES_HOST" not in os.environ:
+        args = {"database": str(server.sqlite_database)}
+        name = "sqlite3"
+    else:
+        args = {
+            "user": os.environ.get("POSTGRES_USER", "synapse"),
+            "password": os.environ.get("POSTGRES_PASSWORD", ""),
+            "database": server.postgres_database,
+            "host": os.environ["POSTGRES_HOST"],
+            "port": int(os.environ.get("POSTGRES_PORT", 5432)),
+            "cp_min": int(profile["DATABASE_CP_MIN"]),
+            "cp_max": int(profile["DATABASE_CP_MAX"]),
+        }
+        name = "psycopg2"
+    lines = ["database:", f"  name: {json.dumps(name)}", "  args:"]
+    lines.extend(f"    {key}: {json.dumps(value)}" for key, value in args.items())
+    return "\n".join(lines)
+
+
+def create_postgres_database(server: Homeserver) -> None:
+    """
+    Create the database of an additional cluster server, through the one of ``POSTGRES_DB``.
+    It needs the ``C`` collation, see the Synapse Postgres documentation.
+    """
+    if "POSTGRES_HOST" not in os.environ:
+        return
+    # part of the Synapse venv, but only needed with Postgres
+    import psycopg2
+    from psycopg2 import sql
+
+    connection = psycopg2.connect(
+        user=os.environ.get("POSTGRES_USER", "synapse"),
+        password=os.environ.get("POSTGRES_PASSWORD", ""),
+        dbname=os.environ.get("POSTGRES_DB", "synapse"),
+        host=os.environ["POSTGRES_HOST"],
+        port=int(os.environ.get("POSTGRES_PORT", 5432)),
+    )
+    # CREATE DATABASE can't run inside a transaction
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_database WHERE datname = %s", (server.postgres_database,)
+            )
+            if cursor.fetchone():
+                return
+            cursor.execute(
+                sql.SQL(
+                    "CREATE DATABASE {} ENCODING 'UTF8' LC_COLLATE 'C' LC_CTYPE 'C' "
+                    "TEMPLATE template0"
+                ).format(sql.Identifier(server.postgres_database))
+            )
+    finally:
+        connection.close()
+
+
+@dataclass
+class Worker:
+    name: str
+    role: str
+    port: int
+
+
+def get_worker_count() -> int:
+    """
+    Number of generic workers from ``SYNAPSE_WORKERS``, 0 (a single process) by default.
+    With ``auto`` there is one worker per CPU core besides the one of the main process.
+    """
+    value = os.environ.get("SYNAPSE_WORKERS", "0")
+    if value == "auto":
+        return max(1, (os.cpu_count() or 1) - 1)
+    return int(value)
+
+
+def plan_workers(count: int) -> List[Worker]:
+    if not count:
+        return []
+    # Nothing in the image routes requests to the workers, nor runs Redis for them
+    if os.environ.get("SYNAPSE_WORKERS_PROXIED") != "true":
+        raise ValueError(
+            "Synapse workers only get requests through a reverse proxy using routes.json, "
+            "which the image doesn't ship. Set SYNAPSE_WORKERS_PROXIED=true with one in front."
+        )
+    if "REDIS_HOST" not in os.environ:
+        raise ValueError("Synapse workers need Redis, set REDIS_HOST")
+    roles = list(WORKER_ROUTES)
+    return [
+        Worker(
+            name=f"{roles[index % len(roles)]}{index // len(roles) + 1}",
+            role=roles[index % len(roles)],
+            port=WORKER_BASE_PORT + index,
+        )
+        for index in range(count)
+    ]
+
+
+def render_worker_main_config(workers: List[Worker]) -> str:
+    """
+    Render the additions to the main process config for workers. They replicate through
+    Redis and the HTTP replication listener of the template, and need a shared database.
+    """
+    if not workers:
+        return ""
+    if "POSTGRES_HOST" not in os.environ:
+        raise ValueError("Synapse workers need Postgres, set POSTGRES_HOST")
+    redis = {
+        "enabled": True,
+        "host": os.environ["REDIS_HOST"],
+        "port": int(os.environ.get("REDIS_PORT", 6379)),
+    }
+    lines = ["redis:"]
+    lines.extend(f"  {key}: {json.dumps(value)}" for key, value in redis.items())
+    return "\n".join(lines)
+
+
+def render_log_config(path: Path, log_file: Path) -> Path:
+    """
+    Write a log config logging to a file of its own. Each Synapse process gets one, as
+    several processes rotating one file lose lines.
+    """
+    config = {
+        "version": 1,
+        "formatters": {
+            "precise": {
+                "format": "%(asctime)s - %(name)s - %(lineno)d - %(levelname)s - "
+                "%(request)s - %(message)s"
+            }
+        },
+        "handlers": {
+            "file": {
+                "class": "logging.handlers.RotatingFileHandler",
+                "formatter": "precise",
+                "filename": str(log_file),
+                "maxBytes": 100 * 1024 * 1024,
+                "backupCount": 3,
+                "encoding": "utf8",
+            }
+        },
+        "root": {"level": "INFO", "handlers": ["file"]},
+        "disable_existing_loggers": False,
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(config, indent=2))
+    return path
+
+
+def render_worker_configs(workers: List[Worker]) -> None:
+    if not workers:
+        shutil.rmtree(PATH_WORKER_CONFIGS, ignore_errors=True)
+        return
+    PATH_WORKER_CONFIGS.mkdir(parents=True, exist_ok=True)
+    for pattern in ("*.yaml", "*.log.config"):
+        for stale_config in PATH_WORKER_CONFIGS.glob(pattern):
+            stale_config.unlink()
+    for worker in workers:
+        config = {
+            "worker_app": "synapse.app.generic_worker",
+            "worker_name": worker.name,
+            "worker_replication_host": "127.0.0.1",
+            "worker_replication_http_port": REPLICATION_HTTP_PORT,
+            "worker_listeners": [
+                {
+                    "type": "http",
+                    "port": worker.port,
+                    "bind_addresses": ["127.0.0.1"],
+                    "x_forwarded": True,
+                    "resources": [{"names": ["client", "federation"], "compress": False}],
+                }
+            ],
+            # next to the logs of supervisord
+            "worker_log_config": str(
+                render_log_config(
+                    PATH_WORKER_CONFIGS / f"{worker.name}.log.config",
+                    PATH_SUPERVISOR_LOGS / f"synapse-{worker.name}.log",
+                )
+            ),
+        }
+        # JSON is valid YAML, and the venv running this script doesn't need a YAML library
+        (PATH_WORKER_CONFIGS / f"{worker.name}.yaml").write_text(json.dumps(config, indent=2))
+
+
+def render_worker_supervisord_config(workers: List[Worker]) -> None:
+    """
+    Write a supervisord program per worker. This has to happen before supervisord starts,
+    see entrypoint.sh. Workers retry until the main process has set up the database.
+    """
+    if not workers:
+        PATH_SUPERVISORD_WORKERS.unlink(missing_ok=True)
+        return
+    programs = []
+    for worker in workers:
+        programs.append(
+            f"[program:synapse-{worker.name}]\n"
+            f"command={PATH_SYNAPSE_PYTHON} -m synapse.app.generic_worker "
+            f"--config-path {PATH_CONFIG} --config-path {PATH_WORKER_CONFIGS / worker.name}.yaml\n"
+            "startsecs=5\n"
+            "startretries=20\n"
+        )
+    PATH_SUPERVISORD_WORKERS.write_text("\n".join(programs))
+
+
+def render_worker_routes(workers: List[Worker]) -> None:
+    """
+    Write the path routing map for a reverse proxy in front of the homeserver: the path
+    patterns of every role with the workers serving them, everything else goes to the main
+    process. /sync should be balanced by user, inbound federation transactions by origin.
+    """
+    if not workers:
+        PATH_WORKER_ROUTES.unlink(missing_ok=True)
+        return
+    routes = [
+        {
+            "role": role,
+            "patterns": patterns,
+            "upstreams": [f"127.0.0.1:{w.port}" for w in workers if w.role == role],
+        }
+        for role, patterns in WORKER_ROUTES.items()
+        if any(worker.role == role for worker in workers)
+    ]
+    PATH_WORKER_ROUTES.parent.mkdir(parents=True, exist_ok=True)
+    PATH_WORKER_ROUTES.write_text(
+        json.dumps({"default": MAIN_PROCESS_LISTENER, "routes": routes}, indent=2)
+    )
+
+
+def render_federation_config(server: Homeserver) -> Dict[str, str]:
+    if not server.federates:
+        return {"FEDERATION_LISTENER": "", "FEDERATION_CONFIG": ""}
+    generate_tls_certificate(server)
+    listener = [
+        "",
+        "  # Clients and the federation between the homeservers of the cluster",
+        f"  - port: {server.tls_port}",
+        "    bind_addresses: ['0.0.0.0']",
+        "    type: http",
+        "    tls: true",
+        "    resources:",
+        "      - names: [client, federation]",
+    ]
+    # the default ip_range_blacklist has loopback and private networks, where the other
+    # servers of the cluster are
+    host = server.server_name.rsplit(":", 1)[0]
+    whitelist = {"127.0.0.0/8", "::1/128"}
+    whitelist.update(info[4][0] for info in socket.getaddrinfo(host, server.tls_port))
+    config = [
+        "",
+        f"tls_certificate_path: {json.dumps(str(server.tls_certificate))}",
+        f"tls_private_key_path: {json.dumps(str(server.tls_private_key))}",
+        f"media_store_path: {json.dumps(str(server.data_dir / 'media_store'))}",
+        "federation_verify_certificates: false",
+        "ip_range_whitelist:",
+        *(f"  - {json.dumps(ip_range)}" for ip_range in sorted(whitelist)),
+    ]
+    return {"FEDERATION_LISTENER": "\n".join(listener), "FEDERATION_CONFIG": "\n".join(config)}
+
+
+def render_server_log_config(server: Homeserver) -> Path:
+    """
+    The first homeserver uses the log config Synapse generates, the others of a cluster log to
+    a file of their own next to the logs of supervisord.
+    """
+    if server.config_dir == PATH_CONFIG_DIR:
+        return PATH_LOG_CONFIG
+    name = server.config_dir.parent.name
+    return render_log_config(
+        server.config_dir / "synapse.log.config", PATH_SUPERVISOR_LOGS / f"synapse-{name}.log"
+    )
+
+
 def render_synapse_config(
-    server_name: str,
+    server: Homeserver,
     eth_rpc_url: str,
     service_registry_address: ChecksumAddress,
+    profile: Dict[str, Any],
+    workers: List[Worker],
 ) -> None:
     template_content = PATH_CONFIG_TEMPLATE.read_text()
     rendered_config = string.Template(template_content).substitute(
-        MACAROON_KEY=get_macaroon_key(),
-        SERVER_NAME=server_name,
+        MACAROON_KEY=get_macaroon_key(server),
+        SERVER_NAME=server.server_name,
         ETH_RPC=eth_rpc_url,
         SERVICE_REGISTRY=service_registry_address,
+        DATABASE_CONFIG=render_database_config(server, profile),
+        WORKER_CONFIG=render_worker_main_config(workers),
+        LOG_CONFIG=render_server_log_config(server),
+        SIGNING_KEY=server.signing_key,
+        ADMIN_CREDENTIALS_FILE=server.admin_credentials,
+        **server.ports,
+        **render_federation_config(server),
+        **profile,
     )
-    PATH_CONFIG.write_text(rendered_config)
+    server.config_dir.mkdir(parents=True, exist_ok=True)
+    (server.data_dir / "log").mkdir(parents=True, exist_ok=True)
+    server.config.write_text(rendered_config)
 
 
-def render_well_known_file(server_name: str) -> None:
-    content = {"m.server": f"{server_name}:443"}
-    PATH_WELL_KNOWN_FILE.write_text(json.dumps(content, indent=2))
+def render_well_known_file(server: Homeserver) -> None:
+    # a cluster server's name already has the port other servers should connect to
+    m_server = server.server_name if server.federates else f"{server.server_name}:443"
+    content = {"m.server": m_server}
+    server.well_known_dir.mkdir(parents=True, exist_ok=True)
+    server.well_known_file.write_text(json.dumps(content, indent=2))
 
 
-def generate_admin_user_credentials():
+def generate_admin_user_credentials(server: Homeserver):
     """
     Generate the username "admin-{server-name}" and a random password combination
     that will be used by various tools in the
     package to authenticate as an admin user via the ``AdminUserAuthProvider``.
     """
-    if PATH_ADMIN_USER_CREDENTIALS.exists():
+    if server.admin_credentials.exists():
         return
-    username = f"admin-{os.environ['SERVER_NAME']}"
+    username = f"admin-{server.server_name}"
     password = "".join(random.choice(string.digits + string.ascii_lowercase) for _ in range(30))
-    PATH_ADMIN_USER_CREDENTIALS.write_text(
+    server.admin_credentials.write_text(
         json.dumps({"username": username, "password": password})
     )
 
 
+def render_known_federation_servers(homeservers: List[Homeserver]) -> None:
+    """
+    Write the names of all cluster servers as a config fragment restricting federation to
+    them. synapse-entrypoint.sh passes it to every server as an additional config file.
+    """
+    if len(homeservers) == 1:
+        PATH_KNOWN_FEDERATION_SERVERS.unlink(missing_ok=True)
+        return
+    lines = ["federation_domain_whitelist:"]
+    lines.extend(f"  - {json.dumps(server.server_name)}" for server in homeservers)
+    PATH_KNOWN_FEDERATION_SERVERS.parent.mkdir(parents=True, exist_ok=True)
+    PATH_KNOWN_FEDERATION_SERVERS.write_text("\n".join(lines) + "\n")
+
+
+def render_cluster_supervisord_config(homeservers: List[Homeserver]) -> None:
+    """
+    Write a supervisord program for each additional homeserver of a cluster, the first one
+    is the synapse program of supervisord.conf.
+    """
+    if len(homeservers) == 1:
+        PATH_SUPERVISORD_CLUSTER.unlink(missing_ok=True)
+        return
+    programs = [
+        f"[program:synapse-{index + 1}]\n"
+        f"command={PATH_SYNAPSE_ENTRYPOINT} {server.config}\n"
+        for index, server in enumerate(homeservers)
+        if index
+    ]
+    PATH_SUPERVISORD_CLUSTER.write_text("\n".join(programs))
+
+
+def render_matrix_server_env_file(homeservers: List[Homeserver]) -> None:
+    """
+    Write the URL of the first homeserver for the Raiden nodes and the PFS of the image. In a
+    cluster that is the TLS listener, so they trust its certificate.
+    """
+    server = homeservers[0]
+    lines = [f"export MATRIX_SERVER={server.client_url}"]
+    if server.federates:
+        lines.append(f"export NODE_EXTRA_CA_CERTS={server.tls_certificate}")
+        lines.append(f"export REQUESTS_CA_BUNDLE={server.tls_certificate}")
+    PATH_MATRIX_SERVER_ENV_FILE.parent.mkdir(parents=True, exist_ok=True)
+    PATH_MATRIX_SERVER_ENV_FILE.write_text("\n".join(lines) + "\n")
+
+
 def main() -> None:
-    server_name = os.environ["SERVER_NAME"]
     eth_rpc_url = os.environ["ETH_RPC"]
     service_registry_address = to_checksum_address(os.environ["SERVICE_REGISTRY"])
-
-    render_synapse_config(
-        server_name=server_name,
-        eth_rpc_url=eth_rpc_url,
-        service_registry_address=service_registry_address,
+    profile = get_performance_profile(
+        os.environ.get("SYNAPSE_PERFORMANCE_PROFILE", DEFAULT_PERFORMANCE_PROFILE)
     )
-    render_well_known_file(server_name=server_name)
-    generate_admin_user_credentials()
+    homeservers = plan_homeservers(
+        count=int(os.environ.get("SYNAPSE_SERVERS", 1)),
+        server_name=os.environ["SERVER_NAME"],
+        host=os.environ.get("SYNAPSE_SERVER_HOST", "localhost"),
+    )
+
+    workers = plan_workers(get_worker_count())
+    if workers and len(homeservers) > 1:
+        raise ValueError("Synapse workers are only supported with a single homeserver")
+
+    for index, server in enumerate(homeservers):
+        if index:
+            create_postgres_database(server)
+        render_synapse_config(
+            server=server,
+            eth_rpc_url=eth_rpc_url,
+            service_registry_address=service_registry_address,
+            profile=profile,
+            workers=workers,
+        )
+        render_well_known_file(server=server)
+        generate_admin_user_credentials(server=server)
+    render_known_federation_servers(homeservers)
+    render_cluster_supervisord_config(homeservers)
+    render_matrix_server_env_file(homeservers)
+    render_worker_configs(workers)
+    render_worker_supervisord_config(workers)
+    render_worker_routes(workers)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,22 @@
 #!/bin/bash
 
-# Ensure data dirs exist
-mkdir -p /opt/synapse/data/log
-mkdir -p /opt/synapse/data/keys
+# Without argument this runs the first homeserver and renders the configs of all of them,
+# the other homeservers of a cluster are started with the path of their rendered config.
+CONFIG_PATH="${1:-/opt/synapse/config/synapse.yaml}"
+KNOWN_FEDERATION_SERVERS=/opt/synapse/data/known_federation_servers.yaml
 
-/opt/synapse/venv/bin/python /usr/local/bin/render_config_template.py
-/opt/synapse/venv/bin/python -m synapse.app.homeserver --config-path /opt/synapse/config/synapse.yaml --generate-keys
-exec /opt/synapse/venv/bin/python -m synapse.app.homeserver --config-path /opt/synapse/config/synapse.yaml
+if [[ -z "$1" ]]; then
+  # Ensure data dirs exist
+  mkdir -p /opt/synapse/data/log
+  mkdir -p /opt/synapse/data/keys
+
+  /opt/synapse/venv/bin/python /usr/local/bin/render_config_template.py
+fi
+
+CONFIG_ARGS=(--config-path "${CONFIG_PATH}")
+if [[ -f "${KNOWN_FEDERATION_SERVERS}" ]]; then
+  CONFIG_ARGS+=(--config-path "${KNOWN_FEDERATION_SERVERS}")
+fi
+
+/opt/synapse/venv/bin/python -m synapse.app.homeserver "${CONFIG_ARGS[@]}" --generate-keys
+exec /opt/synapse/venv/bin/python -m synapse.app.homeserver "${CONFIG_ARGS[@]}"